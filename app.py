@@ -11,14 +11,38 @@ from email.message import EmailMessage
 from datetime import datetime, date
 from pathlib import Path
 import io
+import time
+import re
+import zipfile
+import hashlib
+import functools
+import secrets
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows (solo sviluppo locale, processo singolo)
+    fcntl = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # export per analisi (Parquet/Arrow) non disponibile
+    pa = pq = None
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from flask import (
     Flask, request, redirect, url_for, render_template,
-    flash, send_from_directory, abort, session, jsonify, send_file
+    flash, send_from_directory, abort, session, jsonify, send_file, g, Response
 )
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.schema import CreateTable
+from markupsafe import Markup
+import click
 from werkzeug.utils import secure_filename
 import pandas as pd
+import numpy as np
+from openpyxl import load_workbook
 
 from reportlab.lib.pagesizes import A4, landscape
 from reportlab.platypus import (
@@ -30,6 +54,16 @@ from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from reportlab.lib import colors
 from reportlab.lib.units import cm, mm
 
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+    CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+
+from elaborazioni import (
+    calculate_m2_m3, contesto_processi, leggi_foglio, nome_sicuro, parse_date_safe,
+    to_float_safe, to_int_safe, valori_colonne, workbook_cliente
+)
+
 # --- 2. CONFIGURAZIONE INIZIALE ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 
@@ -37,9 +71,10 @@ DATA_DIR = Path(os.environ.get('RENDER_DISK_PATH', Path(__file__).resolve().pare
 UPLOAD_FOLDER = DATA_DIR / 'uploads_web'
 BACKUP_FOLDER = DATA_DIR / 'backup_web'
 CONFIG_FOLDER = DATA_DIR / 'config'
+DOCUMENTI_FOLDER = DATA_DIR / 'documenti_emessi'
 STATIC_FOLDER = Path(__file__).resolve().parent / 'static'
 
-for folder in [UPLOAD_FOLDER, BACKUP_FOLDER, CONFIG_FOLDER, STATIC_FOLDER]:
+for folder in [UPLOAD_FOLDER, BACKUP_FOLDER, CONFIG_FOLDER, DOCUMENTI_FOLDER, STATIC_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
 app = Flask(__name__)
@@ -71,7 +106,8 @@ USER_CREDENTIALS = {
 ADMIN_USERS = {'OPS', 'CUSTOMS', 'TAZIO', 'DIEGO', 'ADMIN'}
 
 # --- 4. MODELLI DEL DATABASE ---
-class Articolo(db.Model):
+class CampiArticolo:
+    """Colonne comuni ad Articolo (merce attiva) e ArticoloArchivio (merce uscita da tempo)."""
     id = db.Column(db.Integer, primary_key=True)
     codice_articolo = db.Column(db.String(100))
     descrizione = db.Column(db.Text)
@@ -90,7 +126,7 @@ class Articolo(db.Model):
     m3 = db.Column(db.Float)
     posizione = db.Column(db.String(100))
     stato = db.Column(db.String(50), default='In giacenza')
-    data_uscita = db.Column(db.Date, nullable=True)
+    data_uscita = db.Column(db.Date, nullable=True, index=True)
     n_ddt_uscita = db.Column(db.String(50), nullable=True)
     buono_n = db.Column(db.String(50))
     pezzo = db.Column(db.String(100))
@@ -100,42 +136,173 @@ class Articolo(db.Model):
     ns_rif = db.Column(db.String(100))
     mezzi_in_uscita = db.Column(db.String(100))
     note = db.Column(db.Text)
+
+class Articolo(CampiArticolo, db.Model):
+    # AUTOINCREMENT: gli id non vengono mai riusati (quelli archiviati restano in articolo_archivio)
+    __table_args__ = {'sqlite_autoincrement': True}
     allegati = db.relationship('Allegato', backref='articolo', lazy=True, cascade="all, delete-orphan")
 
 class Allegato(db.Model):
+    __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(200), nullable=False)
+    filename = db.Column(db.String(200), nullable=False, index=True)
     tipo = db.Column(db.String(20), nullable=False)
     articolo_id = db.Column(db.Integer, db.ForeignKey('articolo.id'), nullable=False)
 
-# --- 5. FUNZIONI HELPER E PDF ---
-def to_float_safe(val):
-    if val is None: return None
-    try: return float(str(val).replace(',', '.'))
-    except (ValueError, TypeError): return None
-
-def to_int_safe(val):
-    f_val = to_float_safe(val)
-    return int(f_val) if f_val is not None else None
-
-def parse_date_safe(date_string):
-    if not date_string: return None
-    for fmt in ('%Y-%m-%d', '%d/%m/%Y'):
-        try: return datetime.strptime(str(date_string), fmt).date()
-        except (ValueError, TypeError): continue
-    return None
+class ArticoloArchivio(CampiArticolo, db.Model):
+    """Stessa forma di Articolo; gli id sono quelli originali (vedi archivia_articoli_usciti)."""
+    __tablename__ = 'articolo_archivio'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+class AllegatoArchivio(db.Model):
+    __tablename__ = 'allegato_archivio'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    filename = db.Column(db.String(200), nullable=False, index=True)
+    tipo = db.Column(db.String(20), nullable=False)
+    articolo_id = db.Column(db.Integer, db.ForeignKey('articolo_archivio.id'), nullable=False, index=True)
 
+class DocumentoEmesso(db.Model):
+    """DDT e buoni emessi: il PDF è salvato una volta su disco (nome = hash) e riscaricato da lì."""
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(20), nullable=False, index=True)
+    numero = db.Column(db.String(50), nullable=False, index=True)
+    data_emissione = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    utente = db.Column(db.String(100))
+    articoli_ids = db.Column(db.Text)
+    sha256 = db.Column(db.String(64), nullable=False)
+    dimensione = db.Column(db.Integer)
+
+class OccupazionePosizione(db.Model):
+    """
+    Colli, m2 e m3 della merce in giacenza per posizione (testo normalizzato).
+    Aggiornata dai trigger SQLite su articolo (vedi TRIGGER_OCCUPAZIONE), mai dall'app:
+    così resta corretta anche dopo gli UPDATE/DELETE in blocco che non passano dall'ORM.
+    """
+    __tablename__ = 'occupazione_posizione'
+    posizione = db.Column(db.String(100), primary_key=True)
+    n_articoli = db.Column(db.Integer, nullable=False, default=0)
+    colli = db.Column(db.Integer, nullable=False, default=0)
+    m2 = db.Column(db.Float, nullable=False, default=0.0)
+    m3 = db.Column(db.Float, nullable=False, default=0.0)
+
+# --- 5. FUNZIONI HELPER E PDF ---
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def calculate_m2_m3(form_data):
-    l = to_float_safe(form_data.get('lunghezza', 0)) or 0
-    w = to_float_safe(form_data.get('larghezza', 0)) or 0
-    h = to_float_safe(form_data.get('altezza', 0)) or 0
-    c = to_int_safe(form_data.get('n_colli', 1)) or 1
-    m2 = round(l * w * c, 3)
-    m3 = round(l * w * h * c, 3)
-    return m2, m3
+# ---------- QUERY ARTICOLI (tabella attiva + archivio) ----------
+FILTRI_DATA = {
+    'data_ingresso_da': ('data_ingresso', '>='), 'data_ingresso_a': ('data_ingresso', '<='),
+    'data_uscita_da': ('data_uscita', '>='), 'data_uscita_a': ('data_uscita', '<='),
+}
+
+def condizioni_articolo(c, filters, cliente=None):
+    """
+    Condizioni SQL dei filtri di ricerca sulle colonne `c` (Articolo o ArticoloArchivio).
+    Le chiavi che non sono colonne (es. 'ids', 'storico') vengono ignorate.
+    """
+    condizioni = []
+    if cliente:
+        condizioni.append(c.cliente.ilike(cliente))
+    for key, value in filters.items():
+        if key in FILTRI_DATA:
+            date_val = parse_date_safe(value)
+            if date_val:
+                colonna, op = FILTRI_DATA[key]
+                condizioni.append(c[colonna] >= date_val if op == '>=' else c[colonna] <= date_val)
+        elif key == 'id':
+            try:
+                condizioni.append(c.id == int(value))
+            except ValueError:
+                pass
+        elif key in c.keys():
+            condizioni.append(c[key].ilike(f"%{value}%"))
+    return condizioni
+
+def limite_archivio():
+    """Data di uscita più recente presente in archivio (None se l'archivio è vuoto)."""
+    return db.session.query(db.func.max(ArticoloArchivio.data_uscita)).scalar()
+
+def richiede_archivio(filters):
+    """
+    L'archivio serve solo se richiesto esplicitamente ('storico') o se i filtri per data
+    possono includere merce uscita prima del limite dell'archivio.
+    """
+    if filters.get('storico'):
+        return True
+    date_filtri = {k: parse_date_safe(filters.get(k)) for k in FILTRI_DATA}
+    if not any(date_filtri.values()):
+        return False
+    limite = limite_archivio()
+    if limite is None:
+        return False
+    # l'archivio contiene solo merce con ingresso <= uscita <= limite
+    return not any(date_filtri[k] and date_filtri[k] > limite for k in ('data_uscita_da', 'data_ingresso_da'))
+
+def select_articoli(condizioni, includi_archivio=False, colonne=None):
+    """
+    Subquery sulle colonne di Articolo filtrata con `condizioni(c)`; con includi_archivio
+    è la UNION ALL con articolo_archivio. La colonna 'archiviato' distingue le righe.
+    `colonne` limita la select ai campi indicati (default: tutti).
+    """
+    parti = []
+    for modello, archiviato in [(Articolo, False), (ArticoloArchivio, True)][:2 if includi_archivio else 1]:
+        c = modello.__table__.c
+        campi = [c[nome] for nome in colonne] if colonne else list(c)
+        parti.append(db.select(*campi, db.literal(archiviato).label('archiviato')).where(*condizioni(c)))
+    return (db.union_all(*parti) if len(parti) > 1 else parti[0]).subquery()
+
+def nomi_allegati(u, includi_archivio=False):
+    """Nomi file degli allegati per id articolo, per le righe della subquery `u`."""
+    risultato = {}
+    for modello in [Allegato, AllegatoArchivio][:2 if includi_archivio else 1]:
+        righe = db.session.execute(
+            db.select(modello.articolo_id, modello.filename)
+            .where(modello.articolo_id.in_(db.select(u.c.id))).order_by(modello.id)
+        )
+        for articolo_id, filename in righe:
+            risultato.setdefault(articolo_id, []).append(filename)
+    return risultato
+
+def calcola_totali(c, condizioni=(), solo_giacenza=True):
+    """Totali di colli/peso/m2/m3 calcolati nel DB; di default solo merce in giacenza (stato diverso da 'uscito')."""
+    if solo_giacenza:
+        condizioni = [*condizioni, db.or_(c.stato.is_(None), db.func.lower(c.stato) != 'uscito')]
+    colli, peso, m2, m3 = db.session.execute(db.select(
+        db.func.coalesce(db.func.sum(c.n_colli), 0), db.func.coalesce(db.func.sum(c.peso), 0.0),
+        db.func.coalesce(db.func.sum(c.m2), 0.0), db.func.coalesce(db.func.sum(c.m3), 0.0),
+    ).where(*condizioni)).one()
+    return {'colli': int(colli), 'peso': float(peso), 'm2': float(m2), 'm3': float(m3)}
+
+# ---------- READ MODEL (select per colonne, righe leggere al posto degli oggetti ORM) ----------
+COLONNE_ARTICOLO = tuple(c.name for c in Articolo.__table__.columns)
+# la tabella giacenze non mostra note e pezzo
+COLONNE_TABELLA = tuple(nome for nome in COLONNE_ARTICOLO if nome not in ('note', 'pezzo'))
+COLONNE_BUONO = ('id', 'ordine', 'codice_articolo', 'descrizione', 'pezzo', 'n_colli', 'n_arrivo', 'fornitore')
+
+@functools.lru_cache(maxsize=256)
+def _select_ricerca(filtri, cliente, ids, colonne, includi_archivio):
+    filtri = dict(filtri)
+    def condizioni(c):
+        if ids is not None:
+            return condizioni_articolo(c, {}, cliente) + [c.id.in_(ids)]
+        return condizioni_articolo(c, filtri, cliente)
+    return select_articoli(condizioni, includi_archivio, colonne)
+
+def ricerca_articoli(filters, cliente=None, ids=None, colonne=COLONNE_ARTICOLO):
+    """
+    Subquery delle ricerche di /giacenze, /export e /ddt/setup: filtri, cliente, selezione
+    per id e scelta dell'archivio in un solo punto. La select costruita resta in cache per
+    combinazione di filtri e colonne. Ritorna (subquery, includi_archivio).
+    """
+    includi_archivio = ids is None and richiede_archivio(filters)
+    return _select_ricerca(
+        tuple(sorted(filters.items())), cliente, tuple(ids) if ids is not None else None,
+        tuple(colonne), includi_archivio
+    ), includi_archivio
+
+def leggi_articoli(u, ordine='asc'):
+    """Righe (tuple con accesso per nome) della subquery `u`, ordinate per id."""
+    return db.session.execute(db.select(u).order_by(u.c.id.desc() if ordine == 'desc' else u.c.id)).all()
 
 def _logo_flowable(max_w=60*mm, max_h=25*mm, hAlign='LEFT'):
     """Ritorna il logo se presente, con dimensioni ridotte."""
@@ -145,6 +312,106 @@ def _logo_flowable(max_w=60*mm, max_h=25*mm, hAlign='LEFT'):
     return Spacer(0, 0)
 
 
+# ---------- METRICHE (formato Prometheus) ----------
+# Con più worker gunicorn impostare PROMETHEUS_MULTIPROC_DIR (cartella vuota a ogni
+# avvio): ogni processo scrive i propri valori lì e /metrics li aggrega.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    # prometheus_client non crea la cartella: senza, la prima scrittura di una metrica fallisce
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+BUCKET_RICHIESTE = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_LATENCY = Histogram(
+    'gestionale_request_latency_seconds', 'Durata delle richieste HTTP',
+    ['endpoint', 'ruolo'], buckets=BUCKET_RICHIESTE)
+REQUESTS_IN_FLIGHT = Gauge(
+    'gestionale_requests_in_flight', 'Richieste HTTP in corso',
+    ['endpoint'], multiprocess_mode='livesum')
+PDF_RENDER_SECONDS = Histogram(
+    'gestionale_pdf_render_seconds', 'Tempo di generazione dei PDF',
+    ['documento'], buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+PDF_PAGINE = Histogram(
+    'gestionale_pdf_pagine', 'Pagine dei PDF generati',
+    ['documento'], buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+RIGHE_ELABORATE = Counter(
+    'gestionale_righe_elaborate_total', 'Righe importate/esportate',
+    ['operazione'])
+BYTE_ELABORATI = Counter(
+    'gestionale_byte_elaborati_total', 'Byte dei file importati/esportati',
+    ['operazione'])
+DURATA_ELABORAZIONE = Histogram(
+    'gestionale_elaborazione_seconds', 'Durata di import/export (per il calcolo righe/s)',
+    ['operazione'], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+CACHE_PDF = Counter(
+    'gestionale_cache_pdf_total', 'Esiti della cache delle anteprime PDF',
+    ['documento', 'esito'])
+SMTP_SECONDS = Histogram(
+    'gestionale_smtp_invio_seconds', 'Durata invio email SMTP',
+    ['esito'], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+AMMISSIONE_ATTESA = Histogram(
+    'gestionale_ammissione_attesa_seconds', 'Attesa in coda delle rotte pesanti',
+    ['classe'], buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30))
+AMMISSIONE_RIFIUTI = Counter(
+    'gestionale_ammissione_rifiuti_total', 'Richieste pesanti respinte per saturazione',
+    ['classe', 'motivo'])
+
+
+def registra_elaborazione(operazione, righe, n_byte, secondi):
+    """Aggiorna contatori righe/byte e durata per import ed export."""
+    RIGHE_ELABORATE.labels(operazione).inc(righe)
+    BYTE_ELABORATI.labels(operazione).inc(n_byte)
+    DURATA_ELABORAZIONE.labels(operazione).observe(secondi)
+
+
+def bearer_valido(token):
+    """True se la richiesta porta "Authorization: Bearer <token>" (confronto a tempo costante)."""
+    if not token:
+        return False
+    # compare_digest accetta str solo ASCII: si confrontano i byte
+    ricevuto = request.headers.get('Authorization', '').encode('utf-8')
+    return secrets.compare_digest(ricevuto, f'Bearer {token}'.encode('utf-8'))
+
+
+def build_pdf(doc, story, documento):
+    """Esegue doc.build registrando tempo di rendering e numero di pagine."""
+    inizio = time.perf_counter()
+    doc.build(story)
+    PDF_RENDER_SECONDS.labels(documento).observe(time.perf_counter() - inizio)
+    PDF_PAGINE.labels(documento).observe(doc.page)
+    return doc.page
+
+
+@app.before_request
+def metrics_inizio_richiesta():
+    # Registrata prima di check_login: misura anche i redirect al login.
+    g.metrics_endpoint = request.endpoint or 'sconosciuto'
+    g.metrics_inizio = time.perf_counter()
+    REQUESTS_IN_FLIGHT.labels(g.metrics_endpoint).inc()
+
+
+@app.teardown_request
+def metrics_fine_richiesta(exc):
+    inizio = g.pop('metrics_inizio', None)
+    if inizio is None:
+        return
+    endpoint = g.pop('metrics_endpoint')
+    REQUESTS_IN_FLIGHT.labels(endpoint).dec()
+    REQUEST_LATENCY.labels(endpoint, session.get('role') or 'anonimo').observe(time.perf_counter() - inizio)
+
+
+@app.route('/metrics')
+def metrics():
+    # Accesso da sessione admin oppure dallo scraper con "Authorization: Bearer <METRICS_TOKEN>"
+    if not bearer_valido(METRICS_TOKEN) and session.get('role') != 'admin':
+        abort(403)
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
 # ---------- BUONO PRELIEVO (con logo) ----------
 def generate_buono_prelievo_pdf(buffer, dati_buono, articoli):
     doc = SimpleDocTemplate(
@@ -209,7 +476,117 @@ def generate_buono_prelievo_pdf(buffer, dati_buono, articoli):
     story.append(Paragraph("Firma Magazzino: ________________________", body))
     story.append(Spacer(1, 6))
     story.append(Paragraph("Firma Cliente: ________________________", body))
-    doc.build(story)
+    build_pdf(doc, story, 'buono')
+
+# ---------- DDT ----------
+def generate_ddt_pdf(buffer, form, articoli, destinatario):
+    doc = SimpleDocTemplate(
+        buffer, pagesize=A4,
+        topMargin=15*mm, bottomMargin=18*mm,
+        leftMargin=15*mm, rightMargin=15*mm
+    )
+    styles = getSampleStyleSheet()
+    body = ParagraphStyle('Body', parent=styles['Normal'], leading=14)
+    body_style = ParagraphStyle(name='BodySmall', parent=styles['Normal'], fontSize=9, leading=11)
+    title = ParagraphStyle('Title', parent=styles['Heading1'], alignment=TA_CENTER, spaceAfter=6)
+    story = []
+
+    logo = _logo_flowable(70*mm, 28*mm, hAlign='LEFT')
+    if isinstance(logo, RLImage):
+        story.append(logo)
+        story.append(Spacer(1, 6))
+
+    story.append(Paragraph(f"DOCUMENTO DI TRASPORTO N. {form.get('n_ddt', '')}", title))
+    data_uscita = parse_date_safe(form.get('data_uscita'))
+    indirizzo = (destinatario.get('indirizzo') or '').replace('\n', '<br/>')
+    piva = destinatario.get('piva')
+
+    top_tbl = Table([
+        [Paragraph("<b>Mittente:</b><br/>Camar Srl", body),
+         Paragraph(f"<b>Destinatario:</b><br/>{destinatario.get('ragione_sociale', '')}<br/>{indirizzo}"
+                   + (f"<br/>P.IVA {piva}" if piva else ''), body)],
+        [Paragraph(f"<b>Data Uscita:</b> {data_uscita.strftime('%d/%m/%Y') if data_uscita else ''}", body),
+         Paragraph(f"<b>Vettore:</b> {form.get('vettore', '')}", body)],
+        [Paragraph(f"<b>Causale Trasporto:</b> {form.get('causale_trasporto', '')}", body),
+         Paragraph(f"<b>Aspetto dei Beni:</b> {form.get('aspetto_beni', '')}", body)],
+    ], colWidths=[90*mm, 90*mm])
+    top_tbl.setStyle(TableStyle([
+        ('VALIGN', (0,0), (-1,-1), 'TOP'),
+        ('BOTTOMPADDING', (0,0), (-1,-1), 4),
+    ]))
+    story.append(top_tbl)
+    story.append(Spacer(1, 8))
+
+    table_header = [['ID', 'Codice Articolo', 'Descrizione', 'Colli', 'Peso (Kg)', 'm²']]
+    table_data = []
+    tot_colli, tot_peso, tot_m2 = 0, 0.0, 0.0
+    for art in articoli:
+        tot_colli += art.n_colli or 0
+        tot_peso += art.peso or 0.0
+        tot_m2 += art.m2 or 0.0
+        table_data.append([
+            Paragraph(str(art.id), body_style),
+            Paragraph(art.codice_articolo or '', body_style),
+            Paragraph(art.descrizione or '', body_style),
+            Paragraph(str(art.n_colli or ''), body_style),
+            Paragraph(f"{art.peso:.2f}" if art.peso else '', body_style),
+            Paragraph(f"{art.m2:.3f}" if art.m2 else '', body_style),
+        ])
+    totali = [['', '', Paragraph('<b>Totali</b>', body_style), str(tot_colli), f"{tot_peso:.2f}", f"{tot_m2:.3f}"]]
+    t = Table(table_header + table_data + totali, colWidths=[15*mm, 35*mm, 75*mm, 15*mm, 20*mm, 20*mm], repeatRows=1)
+    t.setStyle(TableStyle([
+        ('GRID', (0,0), (-1,-1), 0.5, colors.black),
+        ('BACKGROUND', (0,0), (-1,0), colors.lightgrey),
+        ('VALIGN', (0,0), (-1,-1), 'TOP'),
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('ALIGN', (3,1), (-1,-1), 'RIGHT'),
+    ]))
+    story.append(t)
+    story.append(Spacer(1, 18))
+    story.append(Paragraph("Firma Vettore: ________________________", body))
+    story.append(Spacer(1, 6))
+    story.append(Paragraph("Firma Destinatario: ________________________", body))
+    build_pdf(doc, story, 'ddt')
+
+# ---------- CACHE ANTEPRIME PDF ----------
+class CacheLRU:
+    """Cache LRU limitata e thread-safe (per processo) dei PDF di anteprima."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.dati = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, chiave):
+        with self.lock:
+            valore = self.dati.get(chiave)
+            if valore is not None:
+                self.dati.move_to_end(chiave)
+            return valore
+
+    def put(self, chiave, valore):
+        with self.lock:
+            self.dati[chiave] = valore
+            self.dati.move_to_end(chiave)
+            while len(self.dati) > self.maxsize:
+                self.dati.popitem(last=False)
+
+    def svuota(self):
+        with self.lock:
+            self.dati.clear()
+
+CACHE_ANTEPRIME = CacheLRU(int(os.environ.get('CACHE_ANTEPRIME_MAX', 128)))
+
+def hash_input(*parti):
+    """Hash stabile degli input di un rendering (dizionari ordinati per chiave)."""
+    return hashlib.sha256(json.dumps(parti, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def cache_anteprima_get(documento, chiave):
+    pdf = CACHE_ANTEPRIME.get((documento, chiave))
+    CACHE_PDF.labels(documento, 'hit' if pdf is not None else 'miss').inc()
+    return pdf
+
+def cache_anteprima_put(documento, chiave, pdf):
+    CACHE_ANTEPRIME.put((documento, chiave), pdf)
 
 # ---------- ETICHETTA (logo in alto a sinistra, una pagina) ----------
 @app.route('/etichetta', methods=['GET'])
@@ -232,6 +609,11 @@ def etichetta_preview():
     if session.get('role') != 'admin': 
         abort(403)
 
+    chiave_cache = hash_input(request.form.to_dict())
+    pdf = cache_anteprima_get('etichetta', chiave_cache)
+    if pdf is not None:
+        return send_file(io.BytesIO(pdf), as_attachment=False, download_name='Anteprima_Etichetta.pdf', mimetype='application/pdf')
+
     buffer = io.BytesIO()
     
     # --- INIZIO CORREZIONE ---
@@ -287,11 +669,12 @@ def etichetta_preview():
     story_elements.append(main_table)
     
     try:
-        doc.build(story_elements)
+        build_pdf(doc, story_elements, 'etichetta')
     except Exception as e:
         logging.error(f"Errore generazione etichetta: {e}")
         return "Errore: il testo è troppo lungo per entrare nell'etichetta.", 400
         
+    cache_anteprima_put('etichetta', chiave_cache, buffer.getvalue())
     buffer.seek(0)
     return send_file(buffer, as_attachment=False, download_name='Anteprima_Etichetta.pdf', mimetype='application/pdf')
 
@@ -318,17 +701,111 @@ def send_email_with_attachments(to_address, subject, body_html, attachments):
             elif att_filename.lower().endswith('.png'): ctype = 'image/png'
             maintype, subtype = ctype.split('/', 1)
             msg.add_attachment(file_data, maintype=maintype, subtype=subtype, filename=att_filename)
-    with smtplib.SMTP(smtp_host, port=smtp_port) as server:
-        server.starttls()
-        server.login(smtp_user, smtp_pass)
-        server.send_message(msg)
+    inizio = time.perf_counter()
+    esito = 'errore'
+    try:
+        with smtplib.SMTP(smtp_host, port=smtp_port) as server:
+            server.starttls()
+            server.login(smtp_user, smtp_pass)
+            server.send_message(msg)
+        esito = 'ok'
+    finally:
+        SMTP_SECONDS.labels(esito).observe(time.perf_counter() - inizio)
 
 # --- 6. ROTTE DELL'APPLICAZIONE ---
 @app.before_request
 def check_login():
-    if 'user' not in session and request.endpoint not in ['login', 'static']:
+    if 'user' not in session and request.endpoint not in ['login', 'static', 'metrics', 'api_articoli_batch']:
         return redirect(url_for('login'))
 
+# ---------- CONTROLLO DI AMMISSIONE (rotte pesanti) ----------
+# Export, import e report possono occupare tutti i worker: per ogni classe si ammette un
+# numero limitato di esecuzioni contemporanee, condiviso tra i worker gunicorn tramite
+# lock (flock) su file. Chi trova tutto occupato attende in una coda limitata; con la coda
+# piena riceve subito 429, dopo l'attesa massima 503, entrambi con Retry-After.
+AMMISSIONE_FOLDER = CONFIG_FOLDER / 'ammissione'
+os.makedirs(AMMISSIONE_FOLDER, exist_ok=True)
+
+# endpoint -> (classe, metodi soggetti al limite); le GET dei form restano libere
+ROTTE_PESANTI = {
+    'export_excel': ('export', {'GET'}),
+    'export_by_client': ('export', {'POST'}),
+    'export_analisi': ('export', {'GET'}),
+    'import_excel': ('import', {'POST'}),
+    'import_fogli': ('import', {'POST'}),
+    'report': ('report', {'POST'}),
+}
+# classe -> (esecuzioni contemporanee, posti in coda, attesa massima in secondi)
+LIMITI_AMMISSIONE = {
+    'export': (int(os.environ.get('AMMISSIONE_EXPORT', 2)), 4, 15),
+    'import': (int(os.environ.get('AMMISSIONE_IMPORT', 1)), 2, 30),
+    'report': (int(os.environ.get('AMMISSIONE_REPORT', 2)), 4, 10),
+}
+
+def _prendi_lock(classe, tipo, quanti):
+    """Primo file libero tra <classe>.<tipo>.0..quanti-1: resta bloccato finché il file è aperto."""
+    for i in range(quanti):
+        f = open(AMMISSIONE_FOLDER / f"{classe}.{tipo}.{i}.lock", 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f
+        except OSError:
+            f.close()
+    return None
+
+def acquisisci_slot(classe):
+    """Ritorna (file dello slot, None) oppure (None, motivo del rifiuto)."""
+    limite, posti_coda, attesa_max = LIMITI_AMMISSIONE[classe]
+    slot = _prendi_lock(classe, 'slot', limite)
+    if slot:
+        return slot, None
+    posto = _prendi_lock(classe, 'coda', posti_coda)
+    if posto is None:
+        return None, 'coda_piena'
+    try:
+        scadenza = time.monotonic() + attesa_max
+        while time.monotonic() < scadenza:
+            time.sleep(0.1)
+            slot = _prendi_lock(classe, 'slot', limite)
+            if slot:
+                return slot, None
+        return None, 'attesa_scaduta'
+    finally:
+        posto.close()
+
+@app.before_request
+def controllo_ammissione():
+    rotta = ROTTE_PESANTI.get(request.endpoint)
+    if fcntl is None or rotta is None or request.method not in rotta[1]:
+        return
+    classe = rotta[0]
+    inizio = time.perf_counter()
+    slot, motivo = acquisisci_slot(classe)
+    AMMISSIONE_ATTESA.labels(classe).observe(time.perf_counter() - inizio)
+    if slot is None:
+        AMMISSIONE_RIFIUTI.labels(classe, motivo).inc()
+        logging.warning(f"Richiesta {classe} respinta ({motivo}): {request.method} {request.path} utente {session.get('user')}")
+        attesa_max = LIMITI_AMMISSIONE[classe][2]
+        return Response(
+            f"Troppe operazioni di {classe} in corso. Riprova tra {attesa_max} secondi.",
+            status=429 if motivo == 'coda_piena' else 503, mimetype='text/plain',
+            headers={'Retry-After': str(attesa_max)})
+    g.slot_ammissione = slot
+
+@app.after_request
+def rilascia_slot_a_fine_risposta(response):
+    # le risposte in streaming (ZIP dei clienti, send_file) tengono lo slot fino all'ultimo byte
+    if response.is_streamed and 'slot_ammissione' in g:
+        response.call_on_close(g.pop('slot_ammissione').close)
+    return response
+
+@app.teardown_request
+def rilascia_slot(exc):
+    # risposte già complete ed eccezioni nella vista
+    slot = g.pop('slot_ammissione', None)
+    if slot:
+        slot.close()
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -355,75 +832,101 @@ def main_menu():
         return redirect(url_for('login'))
     return render_template('main_menu.html')
 
+# ---------- TABELLA GIACENZE (cache dei frammenti di riga) ----------
+CACHE_RIGHE = CacheLRU(int(os.environ.get('CACHE_RIGHE_MAX', 20000)))
+
+def righe_giacenze_html(articoli):
+    """
+    HTML delle righe della tabella giacenze. La chiave della cache è la tupla dei
+    valori mostrati (id compreso): una riga modificata cambia chiave, quindi vengono
+    renderizzate solo le righe cambiate.
+    """
+    template = app.jinja_env.get_template('riga_giacenza.html')
+    parti = []
+    for art in articoli:
+        # le righe di ricerca_articoli contengono solo le colonne mostrate (+ 'archiviato');
+        # la tupla intera e non il suo hash(): due righe diverse non condividono mai la chiave
+        chiave = tuple(art)
+        html = CACHE_RIGHE.get(chiave)
+        if html is None:
+            html = template.render(articolo=art)
+            CACHE_RIGHE.put(chiave, html)
+        parti.append(html)
+    return Markup(''.join(parti))
+
 @app.route('/giacenze')
 def visualizza_giacenze():
-    query = Articolo.query
-    if session.get('role') == 'client':
-        query = query.filter(Articolo.cliente.ilike(session['user']))
-
+    cliente = session['user'] if session.get('role') == 'client' else None
     filters = {k: v for k, v in request.args.items() if v}
-    if filters:
-        for key, value in filters.items():
-            if hasattr(Articolo, key):
-                if key in ['data_ingresso_da', 'data_ingresso_a', 'data_uscita_da', 'data_uscita_a']:
-                    date_val = parse_date_safe(value)
-                    if date_val:
-                        if key == 'data_ingresso_da': query = query.filter(Articolo.data_ingresso >= date_val)
-                        if key == 'data_ingresso_a': query = query.filter(Articolo.data_ingresso <= date_val)
-                        if key == 'data_uscita_da': query = query.filter(Articolo.data_uscita >= date_val)
-                        if key == 'data_uscita_a': query = query.filter(Articolo.data_uscita <= date_val)
-                elif key == 'id':
-                    try:
-                        query = query.filter(Articolo.id == int(value))
-                    except ValueError:
-                        pass
-                else:
-                    query = query.filter(getattr(Articolo, key).ilike(f"%{value}%"))
 
-    articoli = query.order_by(Articolo.id.desc()).all()
+    # con 'storico' o filtri per data vecchi include anche le righe archiviate
+    u, _ = ricerca_articoli(filters, cliente, colonne=COLONNE_TABELLA)
+    articoli = leggi_articoli(u, ordine='desc')
+    totali = calcola_totali(u.c)
 
-    totali = { 'colli': 0, 'peso': 0.0, 'm2': 0.0, 'm3': 0.0 }
-    articoli_in_giacenza = [art for art in articoli if not art.stato or str(art.stato).lower() != 'uscito']
-    for art in articoli_in_giacenza:
-        totali['colli'] += art.n_colli or 0
-        totali['peso'] += art.peso or 0.0
-        totali['m2'] += art.m2 or 0.0
-        totali['m3'] += art.m3 or 0.0
+    return render_template('index.html', articoli=articoli, righe_html=righe_giacenze_html(articoli),
+                           totali=totali, filters=filters)
 
-    return render_template('index.html', articoli=articoli, totali=totali, filters=filters)
+def valori_articolo(form):
+    """Valori delle colonne di Articolo dai dati form/import (regole in elaborazioni.valori_colonne)."""
+    return valori_colonne(form, COLONNE_ARTICOLO)
 
 def populate_articolo_from_form(articolo, form):
+    """Popola i campi dell'articolo dai dati form (regole in valori_articolo)."""
+    for nome, valore in valori_articolo(form).items():
+        setattr(articolo, nome, valore)
+    return articolo
+
+def _float_vettoriale(serie):
+    # come to_float_safe: virgola decimale ammessa, valori non numerici -> None
+    # sempre float64: con soli interi pandas darebbe int64, che trabocca nel calcolo di m2/m3
+    testo = serie.astype(str).str.strip().str.replace(',', '.', regex=False)
+    return pd.to_numeric(testo, errors='coerce').astype('float64')
+
+def valori_articoli_batch(records):
     """
-    Popola i campi dell'articolo dai dati form.
-    - Non sovrascrive automaticamente 'stato' (viene rispettato ciò che arriva dal form/import).
-    - Calcola m2/m3 quando sono presenti dati dimensione/colli.
+    Versione vettoriale di valori_articolo per una lista di dict (API batch):
+    stesse regole di conversione, applicate per colonna con pandas. Le chiavi
+    assenti prendono il default della colonna; 'id' viene ignorato.
+    Ritorna una lista di dict con tutte le colonne, pronta per un insert in blocco.
     """
-    for col in Articolo.__table__.columns:
-        if col.name in form:
-            if col.name == 'stato':
-                # NON manipolare automaticamente; copia solo ciò che arriva.
-                value = form.get(col.name)
-                setattr(articolo, col.name, value if value else None)
-                continue
-            value = form.get(col.name)
-            if 'data' in col.name:
-                setattr(articolo, col.name, parse_date_safe(value))
-            elif col.name in ['peso', 'larghezza', 'lunghezza', 'altezza']:
-                setattr(articolo, col.name, to_float_safe(value))
-            elif col.name in ['n_colli']:
-                setattr(articolo, col.name, to_int_safe(value))
-            else:
-                setattr(articolo, col.name, value if (value not in [None, '', 'None']) else None)
-
-    if any(k in form for k in ['lunghezza', 'larghezza', 'altezza', 'n_colli']):
-        calc_data = {
-            'lunghezza': form.get('lunghezza'),
-            'larghezza': form.get('larghezza'),
-            'altezza': form.get('altezza'),
-            'n_colli': form.get('n_colli')
-        }
-        articolo.m2, articolo.m3 = calculate_m2_m3(calc_data)
-    return articolo
+    colonne = [c.name for c in Articolo.__table__.columns if c.name != 'id']
+    # le colonne partono dai valori grezzi (dtype object): un DataFrame.from_records
+    # inferirebbe float64 per le chiavi assenti in qualche record, e un codice
+    # numerico 123456 diventerebbe '123456.0' nei campi di testo
+    presenti = pd.DataFrame({nome: [nome in r for r in records] for nome in colonne})
+    out = pd.DataFrame(index=presenti.index)
+    for nome in colonne:
+        serie = pd.Series([r.get(nome) for r in records], dtype=object)
+        serie = serie.where(serie.notna(), None)
+        if nome == 'stato':
+            default = Articolo.__table__.c.stato.default.arg
+            valori = serie.map(lambda v: v if v else None)
+            out[nome] = valori.where(presenti[nome], default)
+        elif 'data' in nome:
+            testo = serie.astype(str)
+            date_iso = pd.to_datetime(testo, format='%Y-%m-%d', errors='coerce')
+            date_it = pd.to_datetime(testo, format='%d/%m/%Y', errors='coerce')
+            out[nome] = date_iso.fillna(date_it).dt.date.astype(object)
+        elif nome in ['peso', 'larghezza', 'lunghezza', 'altezza', 'm2', 'm3']:
+            out[nome] = _float_vettoriale(serie)
+        elif nome in ['n_colli']:
+            out[nome] = np.trunc(_float_vettoriale(serie)).astype('Int64')
+        else:
+            testo = serie.map(lambda v: None if v is None else str(v))
+            out[nome] = testo.where(~testo.isin(['', 'None']), None)
+
+    # m2/m3 come calculate_m2_m3, solo per i record con almeno un dato dimensione/colli
+    con_dimensioni = presenti[['lunghezza', 'larghezza', 'altezza', 'n_colli']].any(axis=1)
+    l = out['lunghezza'].fillna(0)
+    w = out['larghezza'].fillna(0)
+    h = out['altezza'].fillna(0)
+    c = out['n_colli'].fillna(0).replace(0, 1)
+    # round() di Python (come calculate_m2_m3): numpy arrotonda diversamente i casi a metà
+    out['m2'] = (l * w * c).astype(float).map(lambda v: round(v, 3)).where(con_dimensioni, out['m2'])
+    out['m3'] = (l * w * h * c).astype(float).map(lambda v: round(v, 3)).where(con_dimensioni, out['m3'])
+
+    return out.astype(object).where(out.notna(), None).to_dict('records')
 
 @app.route('/articolo/nuovo', methods=['GET', 'POST'])
 def add_articolo():
@@ -475,120 +978,203 @@ def delete_attachment(id):
     flash('Allegato eliminato.', 'success')
     return redirect(url_for('edit_articolo', id=allegato.articolo_id))
 
-# ---------- IMPORT EXCEL (robusto) ----------
+# ---------- IMPORT EXCEL (robusto, più file e più fogli) ----------
+IMPORT_TEMP_FOLDER = DATA_DIR / 'import_temp'
+MAX_IMPORT_PROCESSI = int(os.environ.get('MAX_IMPORT_PROCESSI', os.cpu_count() or 2))
+IMPORT_BLOCCO = 1000
+
+def carica_profili_import():
+    profiles_path = CONFIG_FOLDER / 'mappe_excel.json'
+    if not profiles_path.exists():
+        return None
+    with open(profiles_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def importa_fogli(lavori):
+    """
+    `lavori`: lista di (percorso, nome file, foglio, nome profilo, profilo).
+    I fogli vengono letti in parallelo in un process pool e inseriti tutti in
+    un'unica transazione: se un foglio non si legge non viene importato nulla.
+    Ritorna (riepilogo per file/foglio, articoli inseriti).
+    """
+    leggi = functools.partial(leggi_foglio, colonne=COLONNE_ARTICOLO)
+    if len(lavori) == 1:
+        esiti = [leggi(*lavori[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=min(len(lavori), MAX_IMPORT_PROCESSI),
+                                 mp_context=contesto_processi()) as executor:
+            esiti = list(executor.map(leggi, *zip(*lavori)))
+
+    riepilogo = [{k: v for k, v in e.items() if k != 'righe'} | {'articoli': len(e['righe'])} for e in esiti]
+    if any(e['errore'] for e in esiti):
+        return riepilogo, 0
+    inseriti = 0
+    try:
+        for esito in esiti:
+            righe = esito['righe']
+            for i in range(0, len(righe), IMPORT_BLOCCO):
+                db.session.execute(db.insert(Articolo), righe[i:i + IMPORT_BLOCCO])
+            inseriti += len(righe)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return riepilogo, inseriti
+
+def _salva_upload(files):
+    """Salva i file caricati in una cartella temporanea; ritorna (token, [(percorso, nome)])."""
+    # cartelle di import abbandonate (selezione fogli mai confermata)
+    if IMPORT_TEMP_FOLDER.exists():
+        for vecchia in IMPORT_TEMP_FOLDER.iterdir():
+            if vecchia.stat().st_mtime < time.time() - 86400:
+                if vecchia.is_dir():
+                    shutil.rmtree(vecchia, ignore_errors=True)
+                else:
+                    vecchia.unlink(missing_ok=True)
+    token = secrets.token_hex(8)
+    cartella = IMPORT_TEMP_FOLDER / token
+    os.makedirs(cartella, exist_ok=True)
+    salvati = []
+    for i, file in enumerate(files):
+        percorso = cartella / f"{i}_{secure_filename(file.filename) or 'import.xlsx'}"
+        file.save(percorso)
+        salvati.append((percorso, file.filename))
+    return token, salvati
+
+def _file_salvati(token):
+    cartella = IMPORT_TEMP_FOLDER / token
+    if not re.fullmatch(r'[0-9a-f]{16}', token or '') or not cartella.is_dir():
+        return None
+    # i file sono salvati come '<indice>_<nome>'
+    percorsi = sorted(cartella.iterdir(), key=lambda p: int(p.name.split('_', 1)[0]))
+    return [(p, p.name.split('_', 1)[1]) for p in percorsi]
+
+def _esegui_import(token, lavori):
+    inizio = time.perf_counter()
+    try:
+        riepilogo, inseriti = importa_fogli(lavori)
+    except Exception as e:
+        logging.error(f"Errore import: {e}", exc_info=True)
+        flash(f"Errore durante l'importazione: {e}", "danger")
+        return redirect(url_for('import_excel'))
+    finally:
+        n_byte = sum(os.path.getsize(p) for p in {l[0] for l in lavori} if os.path.exists(p))
+        shutil.rmtree(IMPORT_TEMP_FOLDER / token, ignore_errors=True)
+    registra_elaborazione('import', inseriti, n_byte, time.perf_counter() - inizio)
+    if any(r['errore'] for r in riepilogo):
+        flash("Importazione annullata: alcuni fogli non sono stati letti. Nessun articolo aggiunto.", "danger")
+    else:
+        flash(f'Importazione completata. {inseriti} articoli aggiunti.', 'success')
+    # post/redirect/get: il riepilogo resta su file, ricaricare la pagina non reimporta
+    with open(IMPORT_TEMP_FOLDER / f'riepilogo_{token}.json', 'w', encoding='utf-8') as f:
+        json.dump({'riepilogo': riepilogo, 'inseriti': inseriti,
+                   'durata': round(time.perf_counter() - inizio, 2)}, f, ensure_ascii=False)
+    return redirect(url_for('import_riepilogo', token=token))
+
+@app.route('/import/riepilogo/<token>')
+def import_riepilogo(token):
+    if session.get('role') != 'admin':
+        abort(403)
+    percorso = IMPORT_TEMP_FOLDER / f'riepilogo_{token}.json'
+    if not re.fullmatch(r'[0-9a-f]{16}', token) or not percorso.exists():
+        abort(404)
+    with open(percorso, 'r', encoding='utf-8') as f:
+        return render_template('import_riepilogo.html', **json.load(f))
+
 @app.route('/import', methods=['GET', 'POST'])
 def import_excel():
     if session.get('role') != 'admin':
         abort(403)
 
-    profiles_path = CONFIG_FOLDER / 'mappe_excel.json'
-    if not profiles_path.exists():
+    profiles = carica_profili_import()
+    if profiles is None:
         flash('File profili (mappe_excel.json) non trovato in config/.', 'danger')
         return render_template('import.html', profiles={})
 
-    with open(profiles_path, 'r', encoding='utf-8') as f:
-        profiles = json.load(f)
-
     if request.method == 'POST':
-        file = request.files.get('file')
+        files = [f for f in request.files.getlist('file') if f and f.filename]
         profile_name = request.form.get('profile')
         profile = profiles.get(profile_name)
 
-        if not file or file.filename == '' or not profile:
+        if not files or not profile:
             flash('File o profilo mancante.', 'warning')
             return redirect(request.url)
 
-        try:
-            df = pd.read_excel(
-                file,
-                header=profile.get('header_row', 0),
-                dtype=str,
-                engine='openpyxl'
-            ).fillna('')
-
-            col_map = profile.get('column_map', {})
-            added_count = 0
-
-            # campi validi esistenti nel modello
-            colonne_valide = set(c.name for c in Articolo.__table__.columns)
-
-            for _, row in df.iterrows():
-                # se nessuna colonna mappata ha dati, salta
-                if not any(row.get(excel_col, '') for excel_col in col_map.keys()):
-                    continue
-
-                new_art = Articolo()
-
-                form_data = {}
-                for excel_col, db_col in col_map.items():
-                    if db_col in colonne_valide:
-                        raw = row.get(excel_col, '')
-                        value = str(raw).strip()
-                        # evita 'nan'/'None' come stringhe
-                        if value.lower() in ['nan', 'none', '']:
-                            value = None
-                        form_data[db_col] = value
-
-                populate_articolo_from_form(new_art, form_data)
-                db.session.add(new_art)
-                added_count += 1
+        token, salvati = _salva_upload(files)
+        if request.form.get('scegli_fogli'):
+            elenco = []
+            for i, (percorso, nome) in enumerate(salvati):
+                try:
+                    wb = load_workbook(percorso, read_only=True)
+                    fogli = wb.sheetnames
+                    wb.close()
+                except Exception as e:
+                    shutil.rmtree(IMPORT_TEMP_FOLDER / token, ignore_errors=True)
+                    flash(f"Impossibile leggere {nome}: {e}", "danger")
+                    return redirect(request.url)
+                elenco.append({'indice': i, 'nome': nome, 'fogli': fogli})
+            return render_template('import_fogli.html', token=token, elenco=elenco,
+                                   profiles=profiles.keys(), profilo_default=profile_name)
 
-            db.session.commit()
-            flash(f'Importazione completata. {added_count} articoli aggiunti.', 'success')
-            return redirect(url_for('visualizza_giacenze'))
-        except Exception as e:
-            db.session.rollback()
-            logging.error(f"Errore import: {e}", exc_info=True)
-            flash(f"Errore durante l'importazione: {e}", "danger")
-            return redirect(request.url)
+        # senza scelta: il primo foglio di ogni file con il profilo indicato
+        return _esegui_import(token, [(str(p), nome, None, profile_name, profile) for p, nome in salvati])
 
     return render_template('import.html', profiles=profiles.keys())
 
+@app.route('/import/fogli', methods=['POST'])
+def import_fogli():
+    if session.get('role') != 'admin':
+        abort(403)
+    profiles = carica_profili_import() or {}
+    token = request.form.get('token', '')
+    salvati = _file_salvati(token)
+    if salvati is None:
+        flash("Import scaduto o non valido: ricaricare i file.", "warning")
+        return redirect(url_for('import_excel'))
+
+    lavori = []
+    for scelta in request.form.getlist('foglio'):
+        # valore 'indice file:nome foglio'
+        indice, _, foglio = scelta.partition(':')
+        nome_profilo = request.form.get(f'profilo_{scelta}')
+        if not indice.isdigit() or int(indice) >= len(salvati) or nome_profilo not in profiles:
+            continue
+        percorso, nome = salvati[int(indice)]
+        lavori.append((str(percorso), nome, foglio, nome_profilo, profiles[nome_profilo]))
+    if not lavori:
+        flash("Nessun foglio selezionato.", "warning")
+        return redirect(url_for('import_excel'))
+    return _esegui_import(token, lavori)
+
 @app.route('/export')
 def export_excel():
     ids_str = request.args.get('ids')
-    query = Articolo.query
-    if session.get('role') == 'client':
-        query = query.filter(Articolo.cliente.ilike(session['user']))
-
+    cliente = session['user'] if session.get('role') == 'client' else None
     filters = {k: v for k, v in request.args.items() if v and k != 'ids'}
-    if filters:
-        for key, value in filters.items():
-            if hasattr(Articolo, key):
-                if key in ['data_ingresso_da', 'data_ingresso_a', 'data_uscita_da', 'data_uscita_a']:
-                    date_val = parse_date_safe(value)
-                    if date_val:
-                        if key == 'data_ingresso_da': query = query.filter(Articolo.data_ingresso >= date_val)
-                        if key == 'data_ingresso_a': query = query.filter(Articolo.data_ingresso <= date_val)
-                        if key == 'data_uscita_da': query = query.filter(Articolo.data_uscita >= date_val)
-                        if key == 'data_uscita_a': query = query.filter(Articolo.data_uscita <= date_val)
-                elif key == 'id':
-                    query = query.filter(Articolo.id == value)
-                else:
-                    query = query.filter(getattr(Articolo, key).ilike(f"%{value}%"))
 
+    ids = None
     if ids_str:
         try:
             ids = [int(i) for i in ids_str.split(',')]
-            query = Articolo.query.filter(Articolo.id.in_(ids))
         except ValueError:
             flash('ID per esportazione non validi.', 'warning')
             return redirect(url_for('visualizza_giacenze'))
 
-    articoli = query.order_by(Articolo.id.asc()).all()
+    inizio = time.perf_counter()
+    u, includi_archivio = ricerca_articoli(filters, cliente, ids)
+    colonne = list(COLONNE_ARTICOLO) + (['archiviato'] if includi_archivio else [])
+    articoli = db.session.execute(db.select(*[u.c[col] for col in colonne]).order_by(u.c.id)).all()
     if not articoli:
         flash('Nessun articolo da esportare per i criteri selezionati.', 'info')
         return redirect(url_for('visualizza_giacenze'))
 
-    data = []
-    for art in articoli:
-        art_data = {c.name: getattr(art, c.name) for c in art.__table__.columns}
-        art_data['allegati'] = ", ".join([a.filename for a in art.allegati])
-        data.append(art_data)
-    df = pd.DataFrame(data)
+    allegati = nomi_allegati(u, includi_archivio)
+    df = pd.DataFrame(articoli, columns=colonne)
+    df['allegati'] = [", ".join(allegati.get(i, [])) for i in df['id']]
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
         df.to_excel(writer, index=False, sheet_name='Giacenze')
+    registra_elaborazione('export', len(articoli), output.tell(), time.perf_counter() - inizio)
     output.seek(0)
     filename = "esportazione_selezionata.xlsx" if ids_str else "esportazione_completa.xlsx"
     return send_file(output, as_attachment=True, download_name=filename, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
@@ -597,24 +1183,27 @@ def export_excel():
 def export_by_client():
     if session.get('role') != 'admin': abort(403)
     if request.method == 'POST':
+        if request.form.get('tutti'):
+            return export_tutti_i_clienti(includi_archivio=bool(request.form.get('storico')))
         cliente_selezionato = request.form.get('cliente')
         if not cliente_selezionato:
             flash("Nessun cliente selezionato.", "warning")
             return redirect(url_for('export_by_client'))
 
-        articoli = Articolo.query.filter_by(cliente=cliente_selezionato).all()
+        inizio = time.perf_counter()
+        includi_archivio = bool(request.form.get('storico'))
+        colonne = list(COLONNE_ARTICOLO) + (['archiviato'] if includi_archivio else [])
+        u = select_articoli(lambda c: [c.cliente == cliente_selezionato], includi_archivio)
+        articoli = db.session.execute(db.select(*[u.c[col] for col in colonne]).order_by(u.c.id)).all()
         if not articoli:
             flash(f"Nessun articolo trovato per il cliente {cliente_selezionato}.", "info")
             return redirect(url_for('export_by_client'))
 
-        data = []
-        for art in articoli:
-            art_data = {c.name: getattr(art, c.name) for c in art.__table__.columns}
-            data.append(art_data)
-        df = pd.DataFrame(data)
+        df = pd.DataFrame(articoli, columns=colonne)
         output = io.BytesIO()
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
             df.to_excel(writer, index=False, sheet_name=cliente_selezionato)
+        registra_elaborazione('export_cliente', len(articoli), output.tell(), time.perf_counter() - inizio)
         output.seek(0)
 
         return send_file(output, as_attachment=True, download_name=f'export_{cliente_selezionato}.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
@@ -622,6 +1211,200 @@ def export_by_client():
     clienti = db.session.query(Articolo.cliente).distinct().order_by(Articolo.cliente).all()
     return render_template('export_by_client.html', clienti=[c[0] for c in clienti if c[0]])
 
+# ---------- EXPORT DI TUTTI I CLIENTI (ZIP) ----------
+MAX_EXPORT_PROCESSI = int(os.environ.get('MAX_EXPORT_PROCESSI', os.cpu_count() or 2))
+CLIENTE_VUOTO = 'SENZA CLIENTE'
+
+class _BufferZip(io.RawIOBase):
+    """Stream non ricercabile: zipfile ci scrive, la risposta svuota i chunk prodotti."""
+    def __init__(self):
+        self.chunks = []
+    def writable(self):
+        return True
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+    def svuota(self):
+        dati = b''.join(self.chunks)
+        self.chunks = []
+        return dati
+
+def export_tutti_i_clienti(includi_archivio=False):
+    """
+    Divide la tabella per cliente in un'unica query e genera i workbook in parallelo
+    in un process pool; lo ZIP viene inviato man mano che i workbook sono pronti,
+    quindi il tempo totale è dato dal cliente più lento e non dalla somma.
+    """
+    inizio = time.perf_counter()
+    colonne = list(COLONNE_ARTICOLO) + (['archiviato'] if includi_archivio else [])
+    u = select_articoli(lambda c: [], includi_archivio)
+    righe = db.session.execute(
+        db.select(*[u.c[col] for col in colonne]).order_by(u.c.cliente, u.c.id)
+    ).all()
+    gruppi = {}
+    for riga in righe:
+        gruppi.setdefault(riga.cliente or CLIENTE_VUOTO, []).append(tuple(riga))
+    del righe
+    if not gruppi:
+        flash("Nessun articolo da esportare.", "info")
+        return redirect(url_for('export_by_client'))
+
+    executor = ProcessPoolExecutor(max_workers=min(len(gruppi), MAX_EXPORT_PROCESSI),
+                                   mp_context=contesto_processi())
+    # i clienti più grandi partono per primi
+    futures = [executor.submit(workbook_cliente, cliente, colonne, gruppi[cliente])
+               for cliente in sorted(gruppi, key=lambda c: len(gruppi[c]), reverse=True)]
+    del gruppi
+
+    def genera():
+        buffer = _BufferZip()
+        tot_righe = tot_byte = 0
+        try:
+            with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zf:
+                for future in as_completed(futures):
+                    cliente, contenuto, n_righe = future.result()
+                    zf.writestr(f'export_{nome_sicuro(cliente, 100)}.xlsx', contenuto)
+                    tot_righe += n_righe
+                    dati = buffer.svuota()
+                    tot_byte += len(dati)
+                    yield dati
+            dati = buffer.svuota()
+            tot_byte += len(dati)
+            yield dati
+            registra_elaborazione('export_tutti', tot_righe, tot_byte, time.perf_counter() - inizio)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    nome_file = f"export_clienti_{date.today().strftime('%Y%m%d')}.zip"
+    return Response(genera(), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{nome_file}"'})
+
+# ---------- EXPORT PER ANALISI (Parquet / Arrow) ----------
+# Per gli strumenti di BI: colonne tipizzate (date, interi, float), cliente e stato
+# come categorie, scritte a blocchi senza passare da pandas/openpyxl.
+ANALISI_BLOCCO = 50000
+FORMATI_ANALISI = {
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('arrow', 'application/vnd.apache.arrow.file'),
+}
+COLONNE_CATEGORICHE = ('cliente', 'stato')
+SNAPSHOT_FOLDER = DATA_DIR / 'snapshot_analisi'
+SNAPSHOT_AUTOMATICO = os.environ.get('SNAPSHOT_ANALISI', '0') == '1'
+SNAPSHOT_CONSERVATI = int(os.environ.get('SNAPSHOT_CONSERVATI', 7))
+
+def schema_analisi(colonne):
+    campi = []
+    for nome in colonne:
+        if nome == 'archiviato':
+            tipo = pa.bool_()
+        elif nome in COLONNE_CATEGORICHE:
+            tipo = pa.dictionary(pa.int32(), pa.string())
+        else:
+            tipo_sql = Articolo.__table__.c[nome].type
+            if isinstance(tipo_sql, db.Integer):
+                tipo = pa.int64()
+            elif isinstance(tipo_sql, db.Float):
+                tipo = pa.float64()
+            elif isinstance(tipo_sql, db.Date):
+                tipo = pa.date32()
+            else:
+                tipo = pa.string()
+        campi.append(pa.field(nome, tipo))
+    return pa.schema(campi)
+
+def scrivi_analisi(destinazione, u, colonne, formato='parquet'):
+    """
+    Scrive le righe della subquery `u` in Parquet o Arrow IPC, un record batch ogni
+    ANALISI_BLOCCO righe lette dal DB. I dizionari delle colonne categoriche sono
+    calcolati prima (DISTINCT), così sono gli stessi in tutti i batch; un valore
+    committato tra il DISTINCT e la lettura viene aggiunto in coda al dizionario
+    (delta: gli indici già scritti restano validi).
+    Ritorna il numero di righe scritte.
+    """
+    schema = schema_analisi(colonne)
+    dizionari = {}
+    for nome in COLONNE_CATEGORICHE:
+        valori = [r[0] for r in db.session.execute(
+            db.select(u.c[nome]).where(u.c[nome].is_not(None)).distinct().order_by(u.c[nome]))]
+        dizionari[nome] = [pa.array(valori, pa.string()), valori, {v: i for i, v in enumerate(valori)}]
+
+    if formato == 'parquet':
+        writer = pq.ParquetWriter(destinazione, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(destinazione, schema, options=pa.ipc.IpcWriteOptions(
+            compression='zstd', emit_dictionary_deltas=True))
+    righe = 0
+    try:
+        risultato = db.session.execute(
+            db.select(*[u.c[nome] for nome in colonne]).order_by(u.c.id)
+            .execution_options(yield_per=ANALISI_BLOCCO))
+        for blocco in risultato.partitions():
+            valori = list(zip(*blocco))
+            array = []
+            for campo, colonna in zip(schema, valori):
+                if campo.name in dizionari:
+                    voce = dizionari[campo.name]
+                    _, elenco, indice = voce
+                    nuovi = sorted(set(colonna) - indice.keys() - {None})
+                    if nuovi:
+                        for v in nuovi:
+                            indice[v] = len(elenco)
+                            elenco.append(v)
+                        voce[0] = pa.array(elenco, pa.string())
+                    indici = pa.array([indice.get(v) for v in colonna], pa.int32())
+                    array.append(pa.DictionaryArray.from_arrays(indici, voce[0]))
+                else:
+                    array.append(pa.array(colonna, campo.type))
+            writer.write_batch(pa.RecordBatch.from_arrays(array, schema=schema))
+            righe += len(blocco)
+    finally:
+        writer.close()
+    return righe
+
+@app.route('/export/analisi')
+def export_analisi():
+    if session.get('role') != 'admin': abort(403)
+    if pa is None:
+        flash("Export per analisi non disponibile: installare pyarrow.", "danger")
+        return redirect(url_for('main_menu'))
+    formato = request.args.get('formato', 'parquet')
+    if formato not in FORMATI_ANALISI:
+        abort(400)
+    filters = {k: v for k, v in request.args.items() if v and k != 'formato'}
+
+    inizio = time.perf_counter()
+    u, includi_archivio = ricerca_articoli(filters)
+    colonne = list(COLONNE_ARTICOLO) + (['archiviato'] if includi_archivio else [])
+    output = io.BytesIO()
+    righe = scrivi_analisi(output, u, colonne, formato)
+    registra_elaborazione(f'export_{formato}', righe, output.tell(), time.perf_counter() - inizio)
+    output.seek(0)
+    estensione, mimetype = FORMATI_ANALISI[formato]
+    return send_file(output, as_attachment=True, mimetype=mimetype,
+                     download_name=f"articoli_{date.today().strftime('%Y%m%d')}.{estensione}")
+
+def snapshot_analisi():
+    """
+    Parquet di tutti gli articoli (tabella attiva e archivio) in SNAPSHOT_FOLDER,
+    un file al giorno; restano gli ultimi SNAPSHOT_CONSERVATI.
+    """
+    os.makedirs(SNAPSHOT_FOLDER, exist_ok=True)
+    destinazione = SNAPSHOT_FOLDER / f"articoli_{date.today().strftime('%Y%m%d')}.parquet"
+    tmp = destinazione.with_suffix('.tmp')
+    u = select_articoli(lambda c: [], includi_archivio=True)
+    righe = scrivi_analisi(str(tmp), u, list(COLONNE_ARTICOLO) + ['archiviato'])
+    os.replace(tmp, destinazione)
+    for vecchio in sorted(SNAPSHOT_FOLDER.glob('articoli_*.parquet'))[:-SNAPSHOT_CONSERVATI]:
+        vecchio.unlink()
+    logging.info(f"Snapshot per analisi: {righe} righe in {destinazione.name}")
+    return destinazione, righe
+
+@app.cli.command('snapshot-analisi')
+def snapshot_analisi_command():
+    """Scrive lo snapshot Parquet di tutti gli articoli nella cartella dei dati."""
+    destinazione, righe = snapshot_analisi()
+    click.echo(f"{righe} righe scritte in {destinazione}")
+
 @app.route('/buono/setup', methods=['GET', 'POST'])
 def buono_setup():
     if session.get('role') != 'admin': abort(403)
@@ -646,6 +1429,7 @@ def buono_setup():
         }
         buffer = io.BytesIO()
         generate_buono_prelievo_pdf(buffer, dati_buono, articoli)
+        archivia_documento('buono', buono_n, articoli, buffer.getvalue())
         buffer.seek(0)
         flash(f"Buono N. {buono_n} assegnato. I dati sono stati salvati.", "success")
         return send_file(buffer, as_attachment=True, download_name=f'Buono_{buono_n}.pdf', mimetype='application/pdf')
@@ -657,7 +1441,9 @@ def buono_preview():
     ids_str = request.args.get('ids', '')
     if not ids_str: return "Errore: Articoli non specificati.", 400
     ids = [int(i) for i in ids_str.split(',')]
-    articoli = Articolo.query.filter(Articolo.id.in_(ids)).all()
+    # anteprima in sola lettura: bastano le colonne stampate sul buono
+    u, _ = ricerca_articoli({}, ids=ids, colonne=COLONNE_BUONO)
+    articoli = leggi_articoli(u)
     primo_articolo = articoli[0] if articoli else None
     dati_buono = {
         'numero_buono': request.form.get('buono_n', '(ANTEPRIMA)'), 'cliente': request.form.get('cliente'),
@@ -665,10 +1451,15 @@ def buono_preview():
         'fornitore': primo_articolo.fornitore if primo_articolo else '',
         'data_emissione': date.today().strftime('%d/%m/%Y'),
     }
-    buffer = io.BytesIO()
-    generate_buono_prelievo_pdf(buffer, dati_buono, articoli)
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=False, download_name='Anteprima_Buono.pdf', mimetype='application/pdf')
+    campi_pdf = [[a.ordine, a.codice_articolo, a.descrizione, a.pezzo, a.n_colli, a.n_arrivo] for a in articoli]
+    chiave_cache = hash_input(dati_buono, campi_pdf)
+    pdf = cache_anteprima_get('buono', chiave_cache)
+    if pdf is None:
+        buffer = io.BytesIO()
+        generate_buono_prelievo_pdf(buffer, dati_buono, articoli)
+        pdf = buffer.getvalue()
+        cache_anteprima_put('buono', chiave_cache, pdf)
+    return send_file(io.BytesIO(pdf), as_attachment=False, download_name='Anteprima_Buono.pdf', mimetype='application/pdf')
 
 def next_ddt_number():
     prog_file = CONFIG_FOLDER / "progressivi_ddt.json"
@@ -759,6 +1550,7 @@ def ddt_finalize():
 
     buffer = io.BytesIO()
     generate_ddt_pdf(buffer, request.form, articoli, destinatario_scelto)
+    archivia_documento('ddt', n_ddt, articoli, buffer.getvalue())
     buffer.seek(0)
 
     flash(f"Articoli aggiornati con DDT N. {n_ddt}. I dati sono stati salvati.", "success")
@@ -766,6 +1558,59 @@ def ddt_finalize():
     return send_file(buffer, as_attachment=True, download_name=download_name, mimetype='application/pdf')
 
 
+# ---------- ARCHIVIO DOCUMENTI EMESSI ----------
+def archivia_documento(tipo, numero, articoli, pdf):
+    """
+    Salva il PDF emesso in documenti_emessi/<tipo>/<sha256>.pdf (una sola copia per
+    contenuto) e registra numero, articoli e hash. Un errore di archiviazione non
+    blocca l'emissione del documento.
+    """
+    sha256 = hashlib.sha256(pdf).hexdigest()
+    try:
+        cartella = DOCUMENTI_FOLDER / tipo
+        os.makedirs(cartella, exist_ok=True)
+        percorso = cartella / f"{sha256}.pdf"
+        if not percorso.exists():
+            tmp = cartella / f"{sha256}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(pdf)
+            os.replace(tmp, percorso)
+        documento = DocumentoEmesso(
+            tipo=tipo, numero=numero, utente=session.get('user'),
+            articoli_ids=','.join(str(a.id) for a in articoli),
+            sha256=sha256, dimensione=len(pdf)
+        )
+        db.session.add(documento)
+        db.session.commit()
+        return documento
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Errore archiviazione {tipo} {numero}: {e}", exc_info=True)
+        return None
+
+@app.route('/documenti')
+def documenti_emessi():
+    if session.get('role') != 'admin': abort(403)
+    query = DocumentoEmesso.query
+    tipo = request.args.get('tipo')
+    numero = request.args.get('numero')
+    if tipo:
+        query = query.filter(DocumentoEmesso.tipo == tipo)
+    if numero:
+        query = query.filter(DocumentoEmesso.numero.ilike(f"%{numero}%"))
+    documenti = query.order_by(DocumentoEmesso.data_emissione.desc()).limit(500).all()
+    return render_template('documenti.html', documenti=documenti, filters=request.args)
+
+@app.route('/documenti/<int:id>/download')
+def download_documento(id):
+    if session.get('role') != 'admin': abort(403)
+    documento = DocumentoEmesso.query.get_or_404(id)
+    prefisso = 'DDT' if documento.tipo == 'ddt' else 'Buono'
+    return send_from_directory(
+        DOCUMENTI_FOLDER / documento.tipo, f"{documento.sha256}.pdf", as_attachment=True,
+        download_name=f"{prefisso}_{documento.numero.replace('/', '-')}.pdf", mimetype='application/pdf'
+    )
+
 @app.route("/ddt/setup")
 def ddt_setup():
     ids = request.args.get("ids", "")
@@ -776,16 +1621,10 @@ def ddt_setup():
     if not id_list:
         return redirect(url_for("visualizza_giacenze"))
 
-    # Carica articoli selezionati
-    articoli = Articolo.query.filter(Articolo.id.in_(id_list)).all()
-
-    # Calcola totali per tabella
-    totali = {
-        "colli": sum(a.n_colli or 0 for a in articoli),
-        "peso": sum(a.peso or 0 for a in articoli),
-        "m2": sum(a.m2 or 0 for a in articoli),
-        "m3": sum(a.m3 or 0 for a in articoli)
-    }
+    # Carica articoli selezionati (solo le colonne della tabella) e totali calcolati nel DB
+    u, _ = ricerca_articoli({}, ids=id_list, colonne=COLONNE_TABELLA)
+    articoli = leggi_articoli(u)
+    totali = calcola_totali(u.c, solo_giacenza=False)
 
     return render_template(
         "ddt_setup.html",
@@ -855,9 +1694,16 @@ def bulk_delete():
     ids_str = request.form.get('selected_ids')
     if ids_str:
         ids = [int(i) for i in ids_str.split(',')]
+        filenames = [r[0] for r in db.session.query(Allegato.filename).filter(Allegato.articolo_id.in_(ids))]
         Allegato.query.filter(Allegato.articolo_id.in_(ids)).delete(synchronize_session=False)
         Articolo.query.filter(Articolo.id.in_(ids)).delete(synchronize_session=False)
         db.session.commit()
+        # i file rimasti per errori di rimozione li recupera riconcilia_allegati()
+        for filename in filenames:
+            try:
+                os.remove(UPLOAD_FOLDER / filename)
+            except OSError:
+                pass
         flash(f"{len(ids)} articoli eliminati con successo.", "success")
     else:
         flash("Nessun articolo selezionato per l'eliminazione.", "warning")
@@ -950,22 +1796,23 @@ def report():
                 ultimo_giorno_numero = calendar.monthrange(anno, mese)[1]
                 fine_mese = date(anno, mese, ultimo_giorno_numero)
                 
-                # --- INIZIO CORREZIONE ---
-                # Sostituisci '==' con 'ilike()' per una ricerca non case-sensitive
-                # Questo troverà "FINCANTIERI" anche se nel DB è salvato come "Fincantieri"
-                articoli_in_giacenza = Articolo.query.filter(
-                    Articolo.cliente.ilike(cliente), # <-- QUI È LA CORREZIONE
-                    Articolo.data_ingresso <= fine_mese,
-                    (Articolo.data_uscita == None) | (Articolo.data_uscita > fine_mese)
-                ).all()
-                # --- FINE CORREZIONE ---
-                
-                m2_totali = sum(art.m2 or 0 for art in articoli_in_giacenza)
-                if not articoli_in_giacenza:
+                # ilike() per una ricerca non case-sensitive ("FINCANTIERI" / "Fincantieri").
+                # L'archivio serve solo per mesi chiusi prima dell'ultima archiviazione.
+                limite = limite_archivio()
+                u = select_articoli(lambda c: [
+                    c.cliente.ilike(cliente),
+                    c.data_ingresso <= fine_mese,
+                    (c.data_uscita == None) | (c.data_uscita > fine_mese)
+                ], includi_archivio=limite is not None and fine_mese < limite)
+                m2_totali, conteggio = db.session.execute(
+                    db.select(db.func.coalesce(db.func.sum(u.c.m2), 0.0), db.func.count())
+                ).one()
+
+                if not conteggio:
                     flash(f"Nessun articolo in giacenza trovato per {cliente} alla fine del periodo {mese:02d}-{anno}.", "info")
                 risultato = {
                     "cliente": cliente, "periodo": f"{mese:02d}-{anno}",
-                    "m2_totali": round(m2_totali, 3), "conteggio_articoli": len(articoli_in_giacenza)
+                    "m2_totali": round(m2_totali, 3), "conteggio_articoli": conteggio
                 }
             except ValueError:
                 flash("Formato data non valido.", "danger")
@@ -979,6 +1826,424 @@ def report():
 def calcolo_costi():
     return redirect(url_for('report'))
 
+# ---------- POSIZIONI DI MAGAZZINO (occupazione per area/corsia/campata) ----------
+CAPACITA_PATH = CONFIG_FOLDER / 'capacita_posizioni.json'
+CAPACITA_DEFAULT_M2 = 20.0
+
+def _sql_in_giacenza(r):
+    """Merce fisicamente a magazzino e con una posizione; `r` è NEW, OLD o l'alias della tabella."""
+    return (f"{r}.data_uscita IS NULL AND ({r}.stato IS NULL OR lower({r}.stato) != 'uscito') "
+            f"AND trim(coalesce({r}.posizione, '')) != ''")
+
+def _sql_aggiungi(r):
+    return f"""
+        INSERT INTO occupazione_posizione (posizione, n_articoli, colli, m2, m3)
+        SELECT upper(trim({r}.posizione)), 1, coalesce({r}.n_colli, 0), coalesce({r}.m2, 0), coalesce({r}.m3, 0)
+        WHERE {_sql_in_giacenza(r)}
+        ON CONFLICT(posizione) DO UPDATE SET n_articoli = n_articoli + 1, colli = colli + excluded.colli,
+            m2 = m2 + excluded.m2, m3 = m3 + excluded.m3;"""
+
+def _sql_togli(r):
+    # quando esce l'ultimo articolo i totali tornano a zero esatto (niente residui dei float)
+    return f"""
+        UPDATE occupazione_posizione SET
+            colli = CASE WHEN n_articoli <= 1 THEN 0 ELSE colli - coalesce({r}.n_colli, 0) END,
+            m2 = CASE WHEN n_articoli <= 1 THEN 0 ELSE m2 - coalesce({r}.m2, 0) END,
+            m3 = CASE WHEN n_articoli <= 1 THEN 0 ELSE m3 - coalesce({r}.m3, 0) END,
+            n_articoli = max(n_articoli - 1, 0)
+        WHERE posizione = upper(trim({r}.posizione)) AND {_sql_in_giacenza(r)};"""
+
+TRIGGER_OCCUPAZIONE = {
+    'occupazione_articolo_insert': f"AFTER INSERT ON articolo BEGIN {_sql_aggiungi('NEW')} END",
+    'occupazione_articolo_delete': f"AFTER DELETE ON articolo BEGIN {_sql_togli('OLD')} END",
+    'occupazione_articolo_update': (
+        "AFTER UPDATE OF posizione, n_colli, m2, m3, stato, data_uscita ON articolo "
+        f"BEGIN {_sql_togli('OLD')} {_sql_aggiungi('NEW')} END"
+    ),
+}
+
+def ricalcola_occupazione():
+    """
+    Ricostruisce l'aggregato con una GROUP BY su articolo. Le posizioni rimaste vuote
+    restano in tabella a zero: sono campate note e libere.
+    """
+    db.session.execute(db.update(OccupazionePosizione).values(n_articoli=0, colli=0, m2=0.0, m3=0.0))
+    db.session.execute(db.text(f"""
+        INSERT INTO occupazione_posizione (posizione, n_articoli, colli, m2, m3)
+        SELECT upper(trim(a.posizione)), count(*), coalesce(sum(a.n_colli), 0),
+               coalesce(sum(a.m2), 0), coalesce(sum(a.m3), 0)
+        FROM articolo a WHERE {_sql_in_giacenza('a')} GROUP BY upper(trim(a.posizione))
+        ON CONFLICT(posizione) DO UPDATE SET n_articoli = excluded.n_articoli, colli = excluded.colli,
+            m2 = excluded.m2, m3 = excluded.m3"""))
+    db.session.commit()
+
+def crea_trigger_occupazione():
+    """Crea i trigger mancanti; al primo avvio (aggregato vuoto) lo popola dai dati esistenti."""
+    for nome, corpo in TRIGGER_OCCUPAZIONE.items():
+        db.session.execute(db.text(f"CREATE TRIGGER IF NOT EXISTS {nome} {corpo}"))
+    db.session.commit()
+    if db.session.query(OccupazionePosizione.posizione).first() is None:
+        ricalcola_occupazione()
+
+@functools.lru_cache(maxsize=8192)
+def scomponi_posizione(posizione):
+    """
+    'A-03-12' -> ('A', '03', '12'). Separatori ammessi: - / . _ spazio; 'B7' -> ('B', '7', None).
+    Oltre il terzo livello le parti finiscono nella campata ('A-03-12-2' -> campata '12-2').
+    """
+    parti = [p for p in re.split(r'[\s\-/._,]+', posizione.strip().upper()) if p]
+    if len(parti) == 1:
+        m = re.fullmatch(r'([A-Z]+)(\d+)', parti[0])
+        if m:
+            parti = list(m.groups())
+    area = parti[0] if parti else ''
+    corsia = parti[1] if len(parti) > 1 else None
+    campata = '-'.join(parti[2:]) or None
+    return area, corsia, campata
+
+def carica_capacita():
+    """Capacità in m2 da config/capacita_posizioni.json: per posizione, per area o default."""
+    capacita = {}
+    if CAPACITA_PATH.exists():
+        try:
+            with open(CAPACITA_PATH, 'r', encoding='utf-8') as f:
+                capacita = json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            logging.error(f"Errore lettura {CAPACITA_PATH.name}: {e}")
+    return {
+        'default_m2': float(capacita.get('default_m2', CAPACITA_DEFAULT_M2)),
+        'aree': {k.upper(): float(v) for k, v in capacita.get('aree', {}).items()},
+        'posizioni': {k.strip().upper(): float(v) for k, v in capacita.get('posizioni', {}).items()},
+    }
+
+def occupazione_posizioni(area=None):
+    """
+    Una voce per posizione nota, letta dall'aggregato (una riga per posizione, nessuna
+    scansione di articolo): area/corsia/campata, colli, m2, m3, capacità e m2 liberi.
+    """
+    capacita = carica_capacita()
+    voci = []
+    for p in OccupazionePosizione.query.order_by(OccupazionePosizione.posizione):
+        p_area, corsia, campata = scomponi_posizione(p.posizione)
+        if area and p_area != area.upper():
+            continue
+        cap = capacita['posizioni'].get(p.posizione, capacita['aree'].get(p_area, capacita['default_m2']))
+        voci.append({
+            'posizione': p.posizione, 'area': p_area, 'corsia': corsia, 'campata': campata,
+            'n_articoli': p.n_articoli, 'colli': p.colli, 'm2': round(p.m2, 3), 'm3': round(p.m3, 3),
+            'capacita_m2': cap, 'libero_m2': round(max(cap - p.m2, 0.0), 3),
+            'percentuale': round(min(p.m2 / cap * 100, 999), 1) if cap else 0.0,
+        })
+    return voci
+
+def posizioni_libere(m2_richiesti, area=None, limite=20):
+    """Posizioni con almeno `m2_richiesti` liberi, la più piena per prima (riempie le campate già usate)."""
+    adatte = [v for v in occupazione_posizioni(area) if v['libero_m2'] >= m2_richiesti]
+    adatte.sort(key=lambda v: (v['libero_m2'], v['posizione']))
+    return adatte[:limite]
+
+@app.route('/posizioni')
+def mappa_posizioni():
+    if session.get('role') != 'admin': abort(403)
+    area = request.args.get('area', '').strip()
+    m2_richiesti = to_float_safe(request.args.get('m2'))
+    voci = occupazione_posizioni()
+    aree = sorted({v['area'] for v in voci})
+    mappa = {}
+    for v in voci:
+        if area and v['area'] != area.upper():
+            continue
+        mappa.setdefault(v['area'], {}).setdefault(v['corsia'] or '-', []).append(v)
+    libere = posizioni_libere(m2_richiesti, area or None) if m2_richiesti is not None else None
+    return render_template('posizioni.html', mappa=mappa, aree=aree, libere=libere,
+                           filters={'area': area, 'm2': request.args.get('m2', '')})
+
+@app.route('/api/posizioni/libere')
+def api_posizioni_libere():
+    if session.get('role') != 'admin': abort(403)
+    m2_richiesti = to_float_safe(request.args.get('m2'))
+    if m2_richiesti is None:
+        return jsonify({'errore': "Parametro 'm2' mancante o non valido."}), 400
+    limite = to_int_safe(request.args.get('limite')) or 20
+    return jsonify(posizioni_libere(m2_richiesti, request.args.get('area') or None, limite))
+
+@app.cli.command('ricalcola-posizioni')
+def ricalcola_posizioni_command():
+    """Ricostruisce l'occupazione per posizione dalla tabella articolo."""
+    ricalcola_occupazione()
+    click.echo(f"Posizioni: {OccupazionePosizione.query.count()}")
+
+# ---------- ALLEGATI ORFANI E SPAZIO SU DISCO ----------
+# File in uploads_web senza riga in allegato/allegato_archivio: eliminazioni in blocco,
+# upload interrotti, import falliti. La riconciliazione gira ogni giorno insieme
+# all'archiviazione (solo analisi, salvo ALLEGATI_PULIZIA_AUTOMATICA=1), dalla pagina
+# /allegati/spazio o con `flask pulisci-allegati`.
+ALLEGATI_GRACE_ORE = int(os.environ.get('ALLEGATI_GRACE_ORE', 24))
+ALLEGATI_QUARANTENA = os.environ.get('ALLEGATI_QUARANTENA', '1') == '1'
+ALLEGATI_PULIZIA_AUTOMATICA = os.environ.get('ALLEGATI_PULIZIA_AUTOMATICA', '0') == '1'
+QUARANTENA_FOLDER = DATA_DIR / 'allegati_quarantena'
+QUARANTENA_GIORNI = int(os.environ.get('QUARANTENA_GIORNI', 30))
+REPORT_ALLEGATI_PATH = CONFIG_FOLDER / 'allegati_report.json'
+# ogni blocco è una IN (...) con un parametro per nome: sotto il limite di 999
+# variabili di SQLite < 3.32 (SQLITE_MAX_VARIABLE_NUMBER)
+ALLEGATI_BLOCCO = 900
+ARTICOLO_ELIMINATO = '(articolo eliminato)'
+
+def _clienti_file(nomi):
+    """
+    Cliente di ogni file: per i file referenziati dall'articolo collegato, per gli orfani
+    dal prefisso '<id articolo>_' del nome (se l'articolo esiste ancora).
+    Ritorna (referenziati {nome: cliente}, orfani {nome: cliente}).
+    """
+    referenziati = {}
+    for modello_all, modello_art in [(Allegato, Articolo), (AllegatoArchivio, ArticoloArchivio)]:
+        righe = db.session.execute(
+            db.select(modello_all.filename, modello_art.cliente)
+            .join(modello_art, modello_art.id == modello_all.articolo_id)
+            .where(modello_all.filename.in_(nomi)))
+        for filename, cliente in righe:
+            referenziati[filename] = cliente or CLIENTE_VUOTO
+    id_orfani = {}
+    for nome in nomi:
+        if nome not in referenziati:
+            prefisso = nome.split('_', 1)[0]
+            id_orfani[nome] = int(prefisso) if prefisso.isdigit() else None
+    clienti_per_id = {}
+    ids = {i for i in id_orfani.values() if i is not None}
+    for modello_art in [Articolo, ArticoloArchivio]:
+        for id_art, cliente in db.session.execute(
+                db.select(modello_art.id, modello_art.cliente).where(modello_art.id.in_(ids))):
+            clienti_per_id[id_art] = cliente or CLIENTE_VUOTO
+    orfani = {nome: clienti_per_id.get(i, ARTICOLO_ELIMINATO) for nome, i in id_orfani.items()}
+    return referenziati, orfani
+
+def _svuota_quarantena():
+    """Elimina i file in quarantena da più di QUARANTENA_GIORNI giorni; ritorna i byte liberati."""
+    if not QUARANTENA_FOLDER.exists():
+        return 0
+    limite = time.time() - QUARANTENA_GIORNI * 86400
+    liberati = 0
+    with os.scandir(QUARANTENA_FOLDER) as voci:
+        for voce in voci:
+            if voce.is_file() and voce.stat().st_mtime < limite:
+                try:
+                    dimensione = voce.stat().st_size
+                    os.remove(voce.path)
+                    liberati += dimensione
+                except OSError:
+                    pass
+    return liberati
+
+def _voce_spazio():
+    return {'file': 0, 'byte': 0, 'recuperabili': 0, 'byte_recuperabili': 0}
+
+def riconcilia_allegati(pulisci=False, grace_ore=None):
+    """
+    Scorre uploads_web a blocchi di ALLEGATI_BLOCCO nomi confrontandoli con le tabelle
+    degli allegati. Con `pulisci` gli orfani più vecchi di `grace_ore` vengono spostati
+    in quarantena (o eliminati con ALLEGATI_QUARANTENA=0). Il riepilogo per cliente
+    viene salvato in config/allegati_report.json e ritornato.
+    """
+    grace_ore = ALLEGATI_GRACE_ORE if grace_ore is None else grace_ore
+    limite_mtime = time.time() - grace_ore * 3600
+    per_cliente = {}
+    totali = {'file': 0, 'byte': 0, 'orfani': 0, 'byte_orfani': 0, 'recuperabili': 0,
+              'byte_recuperabili': 0, 'rimossi': 0, 'byte_rimossi': 0}
+
+    def elabora(blocco):
+        referenziati, orfani = _clienti_file([voce.name for voce, _ in blocco])
+        for voce, st in blocco:
+            totali['file'] += 1
+            totali['byte'] += st.st_size
+            if voce.name in referenziati:
+                voce_cliente = per_cliente.setdefault(referenziati[voce.name], _voce_spazio())
+                voce_cliente['file'] += 1
+                voce_cliente['byte'] += st.st_size
+                continue
+            voce_cliente = per_cliente.setdefault(orfani[voce.name], _voce_spazio())
+            totali['orfani'] += 1
+            totali['byte_orfani'] += st.st_size
+            if st.st_mtime >= limite_mtime:
+                continue  # upload forse ancora in corso
+            voce_cliente['recuperabili'] += 1
+            voce_cliente['byte_recuperabili'] += st.st_size
+            totali['recuperabili'] += 1
+            totali['byte_recuperabili'] += st.st_size
+            if pulisci:
+                try:
+                    if ALLEGATI_QUARANTENA:
+                        os.makedirs(QUARANTENA_FOLDER, exist_ok=True)
+                        os.replace(voce.path, QUARANTENA_FOLDER / voce.name)
+                        os.utime(QUARANTENA_FOLDER / voce.name)  # i giorni di quarantena partono da ora
+                    else:
+                        os.remove(voce.path)
+                    totali['rimossi'] += 1
+                    totali['byte_rimossi'] += st.st_size
+                except OSError as e:
+                    logging.warning(f"Allegato orfano {voce.name} non rimosso: {e}")
+
+    inizio = time.perf_counter()
+    blocco = []
+    with os.scandir(UPLOAD_FOLDER) as voci:
+        for voce in voci:
+            if not voce.is_file():
+                continue
+            blocco.append((voce, voce.stat()))
+            if len(blocco) >= ALLEGATI_BLOCCO:
+                elabora(blocco)
+                blocco = []
+    if blocco:
+        elabora(blocco)
+    if pulisci:
+        totali['byte_quarantena_svuotata'] = _svuota_quarantena()
+
+    report = {
+        'data': datetime.now().isoformat(timespec='seconds'), 'pulizia': pulisci,
+        'grace_ore': grace_ore, 'quarantena': ALLEGATI_QUARANTENA,
+        'durata_s': round(time.perf_counter() - inizio, 3), 'totali': totali,
+        'per_cliente': dict(sorted(per_cliente.items(), key=lambda kv: kv[1]['byte_recuperabili'], reverse=True)),
+    }
+    try:
+        tmp = REPORT_ALLEGATI_PATH.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, REPORT_ALLEGATI_PATH)
+    except IOError as e:
+        logging.error(f"Impossibile salvare il report allegati: {e}")
+    logging.info(f"Riconciliazione allegati: {totali['orfani']} orfani, "
+                 f"{totali['byte_recuperabili']} byte recuperabili, {totali['rimossi']} rimossi.")
+    return report
+
+@app.route('/allegati/spazio', methods=['GET', 'POST'])
+def spazio_allegati():
+    if session.get('role') != 'admin': abort(403)
+    if request.method == 'POST':
+        pulisci = request.form.get('azione') == 'pulisci'
+        report = riconcilia_allegati(pulisci=pulisci)
+        if pulisci:
+            destinazione = 'spostati in quarantena' if ALLEGATI_QUARANTENA else 'eliminati'
+            flash(f"{report['totali']['rimossi']} file orfani {destinazione}.", "success")
+        return redirect(url_for('spazio_allegati'))
+    report = None
+    if REPORT_ALLEGATI_PATH.exists():
+        try:
+            with open(REPORT_ALLEGATI_PATH, 'r', encoding='utf-8') as f:
+                report = json.load(f)
+        except (IOError, json.JSONDecodeError):
+            report = None
+    return render_template('allegati_spazio.html', report=report, grace_ore=ALLEGATI_GRACE_ORE,
+                           quarantena=ALLEGATI_QUARANTENA, quarantena_giorni=QUARANTENA_GIORNI)
+
+@app.cli.command('pulisci-allegati')
+@click.option('--pulisci', is_flag=True, help='Sposta in quarantena (o elimina) gli orfani; senza, solo analisi.')
+@click.option('--ore', type=int, default=None, help='Età minima in ore dei file orfani (default ALLEGATI_GRACE_ORE).')
+def pulisci_allegati_command(pulisci, ore):
+    """Confronta uploads_web con le tabelle degli allegati e riporta lo spazio recuperabile."""
+    totali = riconcilia_allegati(pulisci=pulisci, grace_ore=ore)['totali']
+    click.echo(f"File: {totali['file']}  orfani: {totali['orfani']}  "
+               f"recuperabili: {totali['recuperabili']} ({totali['byte_recuperabili']} byte)  "
+               f"rimossi: {totali['rimossi']}")
+
+# ---------- API INGRESSO MERCE (lettori palmari) ----------
+# POST /api/articoli/batch con sessione admin o "Authorization: Bearer <SCANNER_TOKEN>".
+# Corpo: array JSON, {"articoli": [...]} oppure NDJSON (un oggetto per riga). In una
+# richiesta multipart gli articoli sono nel campo 'articoli' e i file nel campo 'files':
+# ogni articolo elenca in "allegati" i nomi dei file che gli appartengono.
+SCANNER_TOKEN = os.environ.get('SCANNER_TOKEN')
+API_BATCH_MAX = int(os.environ.get('API_BATCH_MAX', 5000))
+
+def _leggi_records_api():
+    """Lista di dict dal corpo della richiesta; ValueError se il formato non è valido."""
+    if request.mimetype == 'multipart/form-data':
+        parte = request.files.get('articoli')
+        testo = parte.read().decode('utf-8') if parte else request.form.get('articoli', '')
+    else:
+        testo = request.get_data(as_text=True)
+    testo = testo.strip()
+    if not testo:
+        raise ValueError('Nessun articolo nel corpo della richiesta.')
+    try:
+        dati = json.loads(testo)
+    except json.JSONDecodeError:
+        # NDJSON
+        dati = []
+        for n, riga in enumerate(testo.splitlines(), 1):
+            if riga.strip():
+                try:
+                    dati.append(json.loads(riga))
+                except json.JSONDecodeError as e:
+                    raise ValueError(f'Riga {n}: JSON non valido ({e.msg}).')
+    if isinstance(dati, dict):
+        dati = dati.get('articoli', [dati])
+    if not isinstance(dati, list) or not all(isinstance(r, dict) for r in dati):
+        raise ValueError('Atteso un array di oggetti articolo.')
+    return dati
+
+@app.route('/api/articoli/batch', methods=['POST'])
+def api_articoli_batch():
+    if not bearer_valido(SCANNER_TOKEN) and session.get('role') != 'admin':
+        return jsonify({'errore': 'Non autorizzato.'}), 401
+
+    inizio = time.perf_counter()
+    try:
+        records = _leggi_records_api()
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'errore': str(e)}), 400
+    if not records:
+        return jsonify({'errore': 'Nessun articolo nel corpo della richiesta.'}), 400
+    if len(records) > API_BATCH_MAX:
+        return jsonify({'errore': f'Massimo {API_BATCH_MAX} articoli per richiesta.'}), 413
+
+    # allegati: verificati tutti prima di scrivere qualsiasi cosa
+    files = {f.filename: f for f in request.files.getlist('files') if f and f.filename}
+    allegati_per_record = []
+    for i, r in enumerate(records):
+        nomi = r.pop('allegati', None) or []
+        if isinstance(nomi, str):
+            nomi = [nomi]
+        for nome in nomi:
+            if nome not in files:
+                return jsonify({'errore': f"Articolo {i}: allegato '{nome}' non presente nella richiesta."}), 400
+            if not allowed_file(nome):
+                return jsonify({'errore': f"Articolo {i}: tipo di file non ammesso ({nome})."}), 400
+        allegati_per_record.append(nomi)
+
+    try:
+        valori = valori_articoli_batch(records)
+    except (ValueError, TypeError, OverflowError) as e:
+        return jsonify({'errore': f'Valori non validi: {e}'}), 400
+    salvati = []
+    try:
+        ids = []
+        for i in range(0, len(valori), IMPORT_BLOCCO):
+            ids.extend(db.session.execute(
+                db.insert(Articolo).returning(Articolo.id, sort_by_parameter_order=True),
+                valori[i:i + IMPORT_BLOCCO]).scalars())
+        righe_allegati = []
+        for id_art, nomi in zip(ids, allegati_per_record):
+            for nome in nomi:
+                filename = secure_filename(f"{id_art}_{datetime.now().timestamp()}_{nome}")
+                files[nome].stream.seek(0)
+                files[nome].save(UPLOAD_FOLDER / filename)
+                salvati.append(UPLOAD_FOLDER / filename)
+                tipo = 'doc' if filename.rsplit('.', 1)[1].lower() == 'pdf' else 'foto'
+                righe_allegati.append({'filename': filename, 'tipo': tipo, 'articolo_id': id_art})
+        if righe_allegati:
+            db.session.execute(db.insert(Allegato), righe_allegati)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        for percorso in salvati:
+            try:
+                os.remove(percorso)
+            except OSError:
+                pass
+        logging.error(f"Errore API batch articoli: {e}", exc_info=True)
+        return jsonify({'errore': f"Errore durante l'inserimento: {e}"}), 500
+
+    registra_elaborazione('api_batch', len(ids), request.content_length or 0, time.perf_counter() - inizio)
+    return jsonify({'inseriti': len(ids), 'ids': ids, 'allegati': len(salvati)}), 201
+
 # ---------- API ALLEGATI ----------
 @app.route('/api/attachments')
 def get_attachments():
@@ -1009,6 +2274,146 @@ def invia_email():
         flash(f"Errore durante l'invio dell'email: {e}", "danger")
     return redirect(request.referrer or url_for('visualizza_giacenze'))
 
+# ---------- ARCHIVIAZIONE MERCE USCITA (tabella attiva / archivio) ----------
+ARCHIVIO_MESI = int(os.environ.get('ARCHIVIO_MESI', 12))
+ARCHIVIO_AUTOMATICO = os.environ.get('ARCHIVIO_AUTOMATICO', '1') == '1'
+# come ALLEGATI_BLOCCO: ogni blocco di id diventa una IN (...) di parametri
+ARCHIVIO_BLOCCO = 900
+_ultimo_controllo_archivio = None
+
+def _sottrai_mesi(giorno, mesi):
+    anno, mese = divmod(giorno.year * 12 + giorno.month - 1 - mesi, 12)
+    mese += 1
+    return date(anno, mese, min(giorno.day, calendar.monthrange(anno, mese)[1]))
+
+def archivia_articoli_usciti(mesi=None):
+    """
+    Sposta in articolo_archivio (con i relativi allegati) gli articoli usciti da più di
+    `mesi` mesi, a blocchi con un commit ciascuno. Gli id restano quelli originali:
+    articolo e allegato sono AUTOINCREMENT (vedi allinea_id_archivio).
+    """
+    mesi = ARCHIVIO_MESI if mesi is None else mesi
+    limite = _sottrai_mesi(date.today(), mesi)
+    colonne_art = [c.name for c in Articolo.__table__.columns]
+    colonne_all = [c.name for c in Allegato.__table__.columns]
+    spostati = 0
+    while True:
+        ids = [r[0] for r in db.session.query(Articolo.id)
+               .filter(Articolo.data_uscita < limite)
+               .order_by(Articolo.id).limit(ARCHIVIO_BLOCCO)]
+        if not ids:
+            break
+        try:
+            db.session.execute(db.insert(ArticoloArchivio.__table__).from_select(
+                colonne_art, db.select(*Articolo.__table__.c).where(Articolo.id.in_(ids))))
+            db.session.execute(db.insert(AllegatoArchivio.__table__).from_select(
+                colonne_all, db.select(*Allegato.__table__.c).where(Allegato.articolo_id.in_(ids))))
+            Allegato.query.filter(Allegato.articolo_id.in_(ids)).delete(synchronize_session=False)
+            Articolo.query.filter(Articolo.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        spostati += len(ids)
+    if spostati:
+        logging.info(f"Archiviati {spostati} articoli usciti prima del {limite.isoformat()}.")
+    return spostati
+
+def allinea_id_archivio():
+    """
+    Gli id di articolo e allegato non devono mai ripetere quelli archiviati. Le tabelle
+    create senza AUTOINCREMENT (SQLite riassegna l'id più alto dopo una cancellazione)
+    vengono ricostruite una volta; a ogni avvio il contatore di SQLite viene portato
+    almeno al massimo id presente in archivio.
+    """
+    for modello, archivio in [(Articolo, ArticoloArchivio), (Allegato, AllegatoArchivio)]:
+        nome = modello.__tablename__
+        sql = db.session.execute(db.text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :n"), {'n': nome}).scalar()
+        if sql and 'AUTOINCREMENT' not in sql.upper():
+            esistenti = {r[1] for r in db.session.execute(db.text(f"PRAGMA table_info({nome})"))}
+            colonne = ', '.join(c.name for c in modello.__table__.columns if c.name in esistenti)
+            crea = str(CreateTable(modello.__table__).compile(dialect=db.engine.dialect)).strip()
+            crea = crea.replace(f'CREATE TABLE {nome} ', f'CREATE TABLE {nome}_nuova ', 1)
+            db.session.commit()
+            # un solo script in transazione; indici e trigger vengono ricreati da initialize_app
+            conn = db.engine.raw_connection()
+            try:
+                conn.driver_connection.executescript(f"""
+                    BEGIN;
+                    {crea};
+                    INSERT INTO {nome}_nuova ({colonne}) SELECT {colonne} FROM {nome};
+                    DROP TABLE {nome};
+                    ALTER TABLE {nome}_nuova RENAME TO {nome};
+                    COMMIT;""")
+            finally:
+                conn.close()
+            logging.info(f"Tabella {nome} ricostruita con AUTOINCREMENT.")
+
+        max_archivio = db.session.query(db.func.max(archivio.id)).scalar() or 0
+        seq = db.session.execute(db.text(
+            "SELECT seq FROM sqlite_sequence WHERE name = :n"), {'n': nome}).scalar()
+        if seq is None:
+            max_attivo = db.session.query(db.func.max(modello.id)).scalar() or 0
+            db.session.execute(db.text("INSERT INTO sqlite_sequence (name, seq) VALUES (:n, :s)"),
+                               {'n': nome, 's': max(max_attivo, max_archivio)})
+        elif seq < max_archivio:
+            db.session.execute(db.text("UPDATE sqlite_sequence SET seq = :s WHERE name = :n"),
+                               {'n': nome, 's': max_archivio})
+        db.session.commit()
+
+        doppi = db.session.query(db.func.count(modello.id)).filter(
+            modello.id.in_(db.select(archivio.id))).scalar()
+        if doppi:
+            logging.error(f"{doppi} id di {nome} sono già presenti in {archivio.__tablename__}: "
+                          "quelle righe non possono essere archiviate finché non vengono rinumerate.")
+
+def _archiviazione_giornaliera():
+    """Eseguita al massimo una volta al giorno, da un solo worker (lock su file)."""
+    lock_path = CONFIG_FOLDER / 'archiviazione.lock'
+    stamp_path = CONFIG_FOLDER / 'ultima_archiviazione.txt'
+    oggi = date.today().isoformat()
+    with open(lock_path, 'w') as lock:
+        if fcntl:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+        if stamp_path.exists() and stamp_path.read_text().strip() == oggi:
+            return
+        try:
+            with app.app_context():
+                archivia_articoli_usciti()
+            stamp_path.write_text(oggi)
+        except Exception as e:
+            logging.error(f"Errore archiviazione automatica: {e}", exc_info=True)
+        try:
+            with app.app_context():
+                riconcilia_allegati(pulisci=ALLEGATI_PULIZIA_AUTOMATICA)
+        except Exception as e:
+            logging.error(f"Errore riconciliazione allegati: {e}", exc_info=True)
+        if SNAPSHOT_AUTOMATICO and pa is not None:
+            try:
+                with app.app_context():
+                    snapshot_analisi()
+            except Exception as e:
+                logging.error(f"Errore snapshot per analisi: {e}", exc_info=True)
+
+@app.before_request
+def avvia_archiviazione_giornaliera():
+    global _ultimo_controllo_archivio
+    oggi = date.today()
+    if not ARCHIVIO_AUTOMATICO or _ultimo_controllo_archivio == oggi:
+        return
+    _ultimo_controllo_archivio = oggi
+    threading.Thread(target=_archiviazione_giornaliera, daemon=True).start()
+
+@app.cli.command('archivia-usciti')
+@click.option('--mesi', type=int, default=None, help='Mesi trascorsi dalla data di uscita (default ARCHIVIO_MESI).')
+def archivia_usciti_command(mesi):
+    """Sposta in archivio gli articoli usciti da più di N mesi."""
+    click.echo(f"Articoli archiviati: {archivia_articoli_usciti(mesi)}")
+
 # --- 7. SETUP E AVVIO APPLICAZIONE ---
 def initialize_app():
     with app.app_context():
@@ -1032,9 +2437,18 @@ def initialize_app():
                 except Exception as e:
                     logging.error(f"Impossibile copiare '{filename}': {e}")
         db.create_all()
+        allinea_id_archivio()
+        # create_all non aggiunge indici a tabelle già esistenti
+        for tabella in db.metadata.sorted_tables:
+            for indice in tabella.indexes:
+                indice.create(db.engine, checkfirst=True)
+        crea_trigger_occupazione()
         logging.info("Database verificato/creato.")
 
-initialize_app()
+# Con 'python app.py' il forkserver e i processi avviati con spawn reimportano questo
+# file come '__mp_main__': lì non va toccato il DB (backup, migrazioni, trigger).
+if __name__ != '__mp_main__':
+    initialize_app()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
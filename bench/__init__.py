@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Suite di benchmark del gestionale.
+
+Uso tipico (dalla radice del progetto):
+
+    python -m bench.run --righe 10000
+    python -m bench.run --righe 100000 --scenari giacenze,export,report
+    python -m bench.run --righe 1000000 --output bench/risultati/1m.json
+
+I dati vengono generati in una cartella temporanea (RENDER_DISK_PATH), quindi
+il database reale non viene mai toccato. I risultati sono scritti in JSON per
+poter confrontare le esecuzioni nel tempo (vedi `python -m bench.run --confronta`).
+"""
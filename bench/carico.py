@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Test di carico contro un gunicorn locale con traffico misto.
+
+Avvia `gunicorn app:app` sul database di benchmark, autentica ogni utente
+virtuale con le credenziali di USER_CREDENTIALS e riproduce un mix di traffico:
+
+- clienti che interrogano periodicamente /giacenze
+- operatori che emettono DDT (/ddt/setup + /ddt/finalize)
+- amministratori che importano file Excel (/import)
+
+In alternativa il mix può essere ricavato da un access log (formato combined
+di gunicorn/nginx) con --access-log. Il report riporta throughput, latenze
+p50/p95/p99 per endpoint, errori e contese di lock (SQLite "database is locked"
+e timeout dei worker, letti dallo stderr di gunicorn).
+
+    python -m bench.carico --righe 100000 --worker 4 --worker-class gthread --threads 4
+    python -m bench.carico --access-log access.log --durata 120
+"""
+import argparse
+import http.cookiejar
+import io
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime
+from pathlib import Path
+
+from bench.fixture_excel import carica_profili, crea_file_excel
+from bench.run import CARTELLA_RISULTATI, PROFILO_IMPORT, RADICE, prepara_ambiente
+
+SEGNALI_CONTESA = {
+    'database_locked': re.compile(r'database is locked', re.I),
+    'worker_timeout': re.compile(r'WORKER TIMEOUT', re.I),
+}
+RIGA_ACCESS_LOG = re.compile(r'"(?P<metodo>GET|POST) (?P<percorso>\S+) HTTP/[\d.]+"')
+
+
+# --- SERVER ---
+def porta_libera():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def avvia_gunicorn(cartella_dati, porta, args, log_path):
+    comando = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{porta}']
+    # senza --config si parte dal gunicorn "nudo"; con --config valgono solo le opzioni esplicite
+    comando += ['--config', args.config] if args.config else ['--config', os.devnull]
+    for opzione, valore in [('--workers', args.worker), ('--worker-class', args.worker_class),
+                            ('--threads', args.threads), ('--timeout', args.timeout)]:
+        if valore is not None:
+            comando += [opzione, str(valore)]
+    env = dict(os.environ, RENDER_DISK_PATH=str(cartella_dati))
+    log = open(log_path, 'w')
+    proc = subprocess.Popen(comando, cwd=RADICE, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{porta}'
+    scadenza = time.time() + 120
+    while time.time() < scadenza:
+        if proc.poll() is not None:
+            raise RuntimeError(f'gunicorn terminato in avvio, vedi {log_path}')
+        try:
+            urllib.request.urlopen(f'{url}/login', timeout=2).read()
+            return proc, url
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError('gunicorn non ha risposto entro 120s')
+
+
+# --- CLIENT HTTP ---
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *a, **kw):
+        return None
+
+
+class UtenteVirtuale:
+    """Sessione HTTP autenticata (cookie di sessione Flask)."""
+
+    def __init__(self, base_url, utente, password):
+        self.base_url = base_url
+        self.utente = utente
+        self.cookie = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookie), _NoRedirect())
+        status, _ = self.richiesta('POST', '/login', dati={'username': utente, 'password': password})
+        if status != 302:
+            raise RuntimeError(f'Login fallito per {utente} (status {status})')
+
+    def richiesta(self, metodo, percorso, dati=None, file=None, timeout=300):
+        headers = {}
+        corpo = None
+        if file:
+            corpo, ctype = _multipart(dati or {}, file)
+            headers['Content-Type'] = ctype
+        elif dati is not None:
+            corpo = urllib.parse.urlencode(dati).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base_url + percorso, data=corpo, headers=headers, method=metodo)
+        try:
+            with self.opener.open(req, timeout=timeout) as r:
+                return r.status, r.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+def _multipart(campi, file):
+    confine = uuid.uuid4().hex
+    buf = io.BytesIO()
+    for k, v in campi.items():
+        buf.write(f'--{confine}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode())
+    for nome_campo, (nome_file, contenuto) in file.items():
+        buf.write(f'--{confine}\r\nContent-Disposition: form-data; name="{nome_campo}"; '
+                  f'filename="{nome_file}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+        buf.write(contenuto)
+        buf.write(b'\r\n')
+    buf.write(f'--{confine}--\r\n'.encode())
+    return buf.getvalue(), f'multipart/form-data; boundary={confine}'
+
+
+# --- MIX DI TRAFFICO ---
+class Statistiche:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latenze = defaultdict(list)
+        self.status = defaultdict(Counter)
+        self.eccezioni = Counter()
+
+    def registra(self, endpoint, secondi, status):
+        with self.lock:
+            self.latenze[endpoint].append(secondi)
+            self.status[endpoint][status] += 1
+
+    def errore(self, endpoint, exc):
+        with self.lock:
+            self.eccezioni[f'{endpoint}: {type(exc).__name__}'] += 1
+
+
+def _misura(stat, endpoint, funzione):
+    t0 = time.perf_counter()
+    try:
+        status, _ = funzione()
+    except Exception as e:  # timeout, connessione chiusa dal worker, ecc.
+        stat.errore(endpoint, e)
+        return
+    stat.registra(endpoint, time.perf_counter() - t0, status)
+
+
+class Azioni:
+    """Azioni scriptate per ruolo. Gli id in giacenza sono condivisi tra gli operatori."""
+
+    def __init__(self, gestionale, righe_import):
+        with gestionale.app.app_context():
+            Articolo = gestionale.Articolo
+            ids = [r[0] for r in gestionale.db.session.query(Articolo.id)
+                   .filter(Articolo.data_uscita.is_(None)).order_by(Articolo.id)]
+        self.ids_in_giacenza = ids
+        self.lock_ids = threading.Lock()
+        self.file_import = crea_file_excel(carica_profili()[PROFILO_IMPORT], righe_import).getvalue()
+        self.contatore_ddt = 0
+
+    def giacenze(self, uv, stat, rnd):
+        _misura(stat, '/giacenze', lambda: uv.richiesta('GET', '/giacenze'))
+
+    def ddt(self, uv, stat, rnd):
+        with self.lock_ids:
+            if len(self.ids_in_giacenza) < 5:
+                return
+            scelti = [self.ids_in_giacenza.pop(rnd.randrange(len(self.ids_in_giacenza)))
+                      for _ in range(rnd.randint(1, 5))]
+            self.contatore_ddt += 1
+            n_ddt = f'C{self.contatore_ddt:05d}/LT'
+        ids = ','.join(str(i) for i in scelti)
+        _misura(stat, '/ddt/setup', lambda: uv.richiesta('GET', f'/ddt/setup?ids={ids}'))
+        _misura(stat, '/ddt/finalize', lambda: uv.richiesta('POST', '/ddt/finalize', dati={
+            'ids': ids, 'n_ddt': n_ddt, 'data_uscita': datetime.now().date().isoformat(),
+            'destinatario_key': 'FINCANTIERI'}))
+
+    def importa(self, uv, stat, rnd):
+        _misura(stat, '/import', lambda: uv.richiesta(
+            'POST', '/import', dati={'profile': PROFILO_IMPORT},
+            file={'file': ('carico.xlsx', self.file_import)}))
+
+    def replay(self, percorso):
+        def azione(uv, stat, rnd):
+            endpoint = urllib.parse.urlsplit(percorso).path
+            _misura(stat, endpoint, lambda: uv.richiesta('GET', percorso))
+        return azione
+
+
+# GET aperte anche ai clienti (con i dati filtrati sul cliente); le altre sono da amministratore
+ROTTE_CLIENTE = {'/', '/giacenze', '/export', '/api/attachments'}
+
+
+def mix_da_access_log(percorso_log, azioni):
+    """
+    Ricava il mix dal log: le GET vengono ripetute così come sono, le POST
+    note (/ddt/finalize, /import) sono sostituite dalle azioni scriptate.
+    Il log non riporta l'utente: le GET di ROTTE_CLIENTE vanno agli utenti
+    cliente, tutto il resto a operatori e amministratori.
+    Ritorna (mix clienti, mix amministratori).
+    """
+    scriptate = {'/ddt/finalize': azioni.ddt, '/import': azioni.importa}
+    mix_clienti, mix_admin = [], []
+    with open(percorso_log, 'r', encoding='utf-8', errors='replace') as f:
+        for riga in f:
+            m = RIGA_ACCESS_LOG.search(riga)
+            if not m:
+                continue
+            percorso = m.group('percorso')
+            endpoint = urllib.parse.urlsplit(percorso).path
+            if m.group('metodo') == 'POST':
+                if endpoint in scriptate:
+                    mix_admin.append(scriptate[endpoint])
+            elif endpoint in ROTTE_CLIENTE:
+                mix_clienti.append(azioni.replay(percorso))
+            elif not endpoint.startswith(('/static', '/login', '/logout', '/uploads')):
+                mix_admin.append(azioni.replay(percorso))
+    if not mix_clienti and not mix_admin:
+        raise ValueError(f'Nessuna richiesta utilizzabile in {percorso_log}')
+    # un log con un solo tipo di traffico: entrambi i ruoli ripetono quello
+    return mix_clienti or mix_admin, mix_admin or mix_clienti
+
+
+def ciclo_utente(uv, mix, pausa, fine, stat, seed):
+    rnd = random.Random(seed)
+    while time.time() < fine:
+        rnd.choice(mix)(uv, stat, rnd)
+        time.sleep(rnd.uniform(0, 2 * pausa))
+
+
+# --- REPORT ---
+def percentile(valori, p):
+    if not valori:
+        return None
+    ordinati = sorted(valori)
+    k = min(len(ordinati) - 1, max(0, round(p / 100 * (len(ordinati) - 1))))
+    return round(ordinati[k], 4)
+
+
+def costruisci_report(stat, durata, log_path, args):
+    with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+        log = f.read()
+    per_endpoint = {}
+    for endpoint, lat in sorted(stat.latenze.items()):
+        status = stat.status[endpoint]
+        per_endpoint[endpoint] = {
+            'richieste': len(lat),
+            'rps': round(len(lat) / durata, 2),
+            'p50_s': percentile(lat, 50),
+            'p95_s': percentile(lat, 95),
+            'p99_s': percentile(lat, 99),
+            'errori': sum(n for s, n in status.items() if s >= 400),
+            'status': {str(s): n for s, n in sorted(status.items())},
+        }
+    totale = sum(len(lat) for lat in stat.latenze.values())
+    return {
+        'meta': {
+            'data': datetime.now().isoformat(timespec='seconds'),
+            'righe': args.righe, 'worker': args.worker, 'worker_class': args.worker_class,
+            'threads': args.threads, 'config': args.config, 'durata_s': round(durata, 1),
+            'clienti': args.clienti, 'operatori': args.operatori, 'admin': args.admin,
+            'access_log': args.access_log,
+        },
+        'throughput_rps': round(totale / durata, 2),
+        'richieste_totali': totale,
+        'endpoint': per_endpoint,
+        'eccezioni_client': dict(stat.eccezioni),
+        'contese': {nome: len(rx.findall(log)) for nome, rx in SEGNALI_CONTESA.items()},
+    }
+
+
+def stampa_report(report):
+    print(f"\nThroughput: {report['throughput_rps']} req/s su {report['richieste_totali']} richieste")
+    print(f"{'endpoint':<18} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'errori':>7}")
+    for endpoint, r in report['endpoint'].items():
+        print(f"{endpoint:<18} {r['richieste']:>6} {r['p50_s']:>8.3f} {r['p95_s']:>8.3f} "
+              f"{r['p99_s']:>8.3f} {r['errori']:>7}")
+    print(f"Contese: {report['contese']}  Eccezioni client: {report['eccezioni_client']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Test di carico del gestionale su gunicorn locale.')
+    parser.add_argument('--righe', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--worker', type=int, default=None, help='Default gunicorn: 1 (o dal --config)')
+    parser.add_argument('--worker-class', default=None)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--timeout', type=int, default=None)
+    parser.add_argument('--config', default=None, help='File di configurazione gunicorn (es. gunicorn.conf.py)')
+    parser.add_argument('--durata', type=int, default=60, help='Secondi di traffico')
+    parser.add_argument('--clienti', type=int, default=10, help='Utenti cliente che interrogano /giacenze')
+    parser.add_argument('--operatori', type=int, default=2, help='Operatori che emettono DDT')
+    parser.add_argument('--admin', type=int, default=1, help='Amministratori che importano file')
+    parser.add_argument('--pausa', type=float, default=1.0, help='Pausa media tra due azioni (s)')
+    parser.add_argument('--righe-import', type=int, default=500)
+    parser.add_argument('--access-log', default=None, help='Access log da cui ricavare il mix')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args(argv)
+
+    # il carico modifica i dati (DDT, import): cartella separata da quella di bench.run
+    cartella_dati = Path(tempfile.gettempdir()) / f'gestionale_carico_{args.righe}_{args.seed}'
+    gestionale = prepara_ambiente(cartella_dati, args.righe, args.seed)
+    azioni = Azioni(gestionale, args.righe_import)
+
+    log_path = cartella_dati / 'gunicorn_carico.log'
+    proc, url = avvia_gunicorn(cartella_dati, porta_libera(), args, log_path)
+    try:
+        clienti = [u for u in gestionale.USER_CREDENTIALS if u not in gestionale.ADMIN_USERS]
+        amministratori = sorted(gestionale.ADMIN_USERS)
+        if args.access_log:
+            # stessi utenti del mix sintetico: i clienti vedono solo le proprie giacenze
+            mix_clienti, mix_admin = mix_da_access_log(args.access_log, azioni)
+            ruoli = ([(clienti[i % len(clienti)], mix_clienti) for i in range(args.clienti)]
+                     + [(amministratori[i % len(amministratori)], mix_admin)
+                        for i in range(args.operatori + args.admin)])
+        else:
+            ruoli = ([(clienti[i % len(clienti)], [azioni.giacenze]) for i in range(args.clienti)]
+                     + [(amministratori[i % len(amministratori)], [azioni.ddt]) for i in range(args.operatori)]
+                     + [(amministratori[i % len(amministratori)], [azioni.importa]) for i in range(args.admin)])
+
+        utenti = [(UtenteVirtuale(url, nome, gestionale.USER_CREDENTIALS[nome]), mix) for nome, mix in ruoli]
+        stat = Statistiche()
+        inizio = time.time()
+        fine = inizio + args.durata
+        threads = [threading.Thread(target=ciclo_utente, args=(uv, mix, args.pausa, fine, stat, args.seed + i))
+                   for i, (uv, mix) in enumerate(utenti)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        durata = time.time() - inizio
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+    report = costruisci_report(stat, durata, log_path, args)
+    stampa_report(report)
+    etichetta = Path(args.config).stem.replace('.', '_') if args.config else (args.worker_class or 'sync')
+    output = Path(args.output) if args.output else (
+        CARTELLA_RISULTATI / f"carico_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{etichetta}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f'Report salvato in {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Generatore di dati sintetici (Articolo/Allegato) con seme fisso.
+
+La distribuzione dei clienti riproduce lo sbilanciamento dei clienti reali:
+pochi clienti (FINCANTIERI, DE WAVE) hanno la maggior parte delle righe.
+"""
+import random
+from datetime import date, timedelta
+
+# Peso relativo dei clienti (circa la ripartizione reale delle giacenze)
+PESI_CLIENTI = {
+    'FINCANTIERI': 34, 'DE WAVE': 22, 'WINGECO': 12, 'DUFERCO': 9,
+    'DE WAVE REFITTING': 8, 'SGDP': 6, 'AMICO': 5, 'SCORZA': 4,
+}
+
+FORNITORI = ['ABB', 'SIEMENS', 'WARTSILA', 'SCHNEIDER', 'DANFOSS', 'ALFA LAVAL',
+             'RINA', 'MARINE INTERIORS', 'SIEM', 'NORTH SAILS']
+STATI = ['In giacenza', 'NAZIONALE', 'DOGANALE']
+AREE = ['A', 'B', 'C', 'D', 'EST', 'OVEST']
+MEZZI = ['BILICO', 'MOTRICE', 'FURGONE', 'CONTAINER 40']
+
+DIMENSIONE_BLOCCO = 10000
+
+
+def _posizione(rnd):
+    """Posizioni nel formato area-corsia-campata (es. 'B-04-12')."""
+    return f"{rnd.choice(AREE)}-{rnd.randint(1, 20):02d}-{rnd.randint(1, 30):02d}"
+
+
+def genera_riga_articolo(rnd, id_articolo, oggi=None):
+    """Ritorna un dizionario con i campi di una riga Articolo realistica."""
+    oggi = oggi or date.today()
+    cliente = rnd.choices(list(PESI_CLIENTI), weights=list(PESI_CLIENTI.values()))[0]
+    data_ingresso = oggi - timedelta(days=rnd.randint(0, 6 * 365))
+    # circa il 60% della merce risulta già uscita
+    uscito = rnd.random() < 0.6
+    data_uscita = None
+    if uscito:
+        data_uscita = min(oggi, data_ingresso + timedelta(days=rnd.randint(1, 400)))
+    n_colli = rnd.choice([1, 1, 1, 2, 2, 3, 4, 6, 10])
+    lunghezza = round(rnd.uniform(0.2, 6.0), 2)
+    larghezza = round(rnd.uniform(0.2, 2.4), 2)
+    altezza = round(rnd.uniform(0.1, 2.5), 2)
+    commessa = f"{rnd.randint(6000, 6300)}"
+    return {
+        'id': id_articolo,
+        'codice_articolo': f"{rnd.randint(100000, 999999)}-{rnd.randint(1, 99):02d}",
+        'descrizione': ' '.join(rnd.choices(
+            ['CASSA', 'PALLET', 'TUBO', 'VALVOLA', 'QUADRO', 'PANNELLO', 'MOTORE',
+             'CAVI', 'LAMIERA', 'ARREDO', 'POMPA', 'FLANGIA', 'RICAMBI'], k=rnd.randint(2, 8))),
+        'cliente': cliente,
+        'fornitore': rnd.choice(FORNITORI),
+        'data_ingresso': data_ingresso,
+        'n_ddt_ingresso': f"{rnd.randint(1, 9999)}/{data_ingresso.strftime('%y')}",
+        'commessa': commessa,
+        'ordine': f"OA{rnd.randint(10000, 99999)}",
+        'n_colli': n_colli,
+        'peso': round(rnd.uniform(5, 3000), 1),
+        'larghezza': larghezza,
+        'lunghezza': lunghezza,
+        'altezza': altezza,
+        'm2': round(lunghezza * larghezza * n_colli, 3),
+        'm3': round(lunghezza * larghezza * altezza * n_colli, 3),
+        'posizione': _posizione(rnd),
+        'stato': 'Uscito' if uscito and rnd.random() < 0.5 else rnd.choice(STATI),
+        'data_uscita': data_uscita,
+        'n_ddt_uscita': f"{rnd.randint(1, 999):03d}/{data_uscita.strftime('%y')}" if data_uscita else None,
+        'buono_n': f"B{rnd.randint(1, 5000)}" if uscito and rnd.random() < 0.3 else None,
+        'pezzo': str(rnd.randint(1, 50)) if rnd.random() < 0.3 else None,
+        'protocollo': f"P{rnd.randint(1000, 9999)}" if rnd.random() < 0.4 else None,
+        'serial_number': f"SN{rnd.randint(10**7, 10**8)}" if rnd.random() < 0.2 else None,
+        'n_arrivo': f"{rnd.randint(1, 2000)}/{data_ingresso.strftime('%y')}",
+        'ns_rif': f"CMR{rnd.randint(100, 999)}" if rnd.random() < 0.3 else None,
+        'mezzi_in_uscita': rnd.choice(MEZZI) if uscito else None,
+        'note': 'Collo danneggiato in arrivo' if rnd.random() < 0.05 else None,
+    }
+
+
+def genera_articoli(n, seed=42, id_iniziale=1, oggi=None):
+    """Generatore di `n` righe Articolo, deterministico per un dato seme."""
+    rnd = random.Random(seed)
+    for i in range(n):
+        yield genera_riga_articolo(rnd, id_iniziale + i, oggi=oggi)
+
+
+def genera_allegati(righe_articolo, seed=42, id_iniziale=1):
+    """Circa un allegato ogni tre articoli (foto o PDF)."""
+    rnd = random.Random(seed + 1)
+    id_allegato = id_iniziale
+    for riga in righe_articolo:
+        for _ in range(rnd.choice([0, 0, 0, 0, 1, 1, 2])):
+            tipo = rnd.choice(['doc', 'foto'])
+            ext = 'pdf' if tipo == 'doc' else 'jpg'
+            yield {
+                'id': id_allegato,
+                'filename': f"{riga['id']}_{id_allegato}_bench.{ext}",
+                'tipo': tipo,
+                'articolo_id': riga['id'],
+            }
+            id_allegato += 1
+
+
+def popola_database(db, Articolo, Allegato, n, seed=42):
+    """
+    Inserisce `n` articoli (con allegati) a blocchi, senza passare dall'ORM.
+    Ritorna il numero di articoli e allegati inseriti.
+    """
+    tot_articoli = tot_allegati = 0
+    blocco = []
+    rnd_seed = seed
+    id_allegato = 1
+    for riga in genera_articoli(n, seed=seed):
+        blocco.append(riga)
+        if len(blocco) >= DIMENSIONE_BLOCCO:
+            id_allegato, n_all = _inserisci_blocco(db, Articolo, Allegato, blocco, rnd_seed, id_allegato)
+            tot_articoli += len(blocco)
+            tot_allegati += n_all
+            rnd_seed += 1
+            blocco = []
+    if blocco:
+        _, n_all = _inserisci_blocco(db, Articolo, Allegato, blocco, rnd_seed, id_allegato)
+        tot_articoli += len(blocco)
+        tot_allegati += n_all
+    db.session.commit()
+    return tot_articoli, tot_allegati
+
+
+def _inserisci_blocco(db, Articolo, Allegato, blocco, seed, id_allegato):
+    allegati = list(genera_allegati(blocco, seed=seed, id_iniziale=id_allegato))
+    db.session.execute(Articolo.__table__.insert(), blocco)
+    if allegati:
+        db.session.execute(Allegato.__table__.insert(), allegati)
+    db.session.commit()
+    return id_allegato + len(allegati), len(allegati)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Fixture Excel conformi ai profili di `mappe_excel.json`.
+
+Ogni file rispetta `header_row` (righe di intestazione libere prima dei titoli)
+e usa esattamente le colonne di `column_map`, così `import_excel` lo legge
+come un file vero del cliente.
+"""
+import io
+import json
+import random
+from pathlib import Path
+
+from openpyxl import Workbook
+
+from bench.dati import genera_articoli
+
+PERCORSI_PROFILI = [
+    Path(__file__).resolve().parent.parent / 'config.' / 'mappe_excel.json',
+    Path(__file__).resolve().parent.parent / 'mappe_excel.json',
+]
+
+
+def carica_profili(percorso=None):
+    candidati = [Path(percorso)] if percorso else PERCORSI_PROFILI
+    for p in candidati:
+        if p.exists():
+            with open(p, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    raise FileNotFoundError('mappe_excel.json non trovato.')
+
+
+def _valore_cella(riga, db_col, rnd):
+    """Valore della cella per la colonna DB mappata (stringhe come nei file reali)."""
+    chiave = db_col.lower()
+    if chiave in riga:
+        valore = riga[chiave]
+    elif chiave == 'magazzino':
+        valore = rnd.choice(['STRUPPA', 'SESTRI', 'PORTO'])
+    else:
+        valore = None
+    if valore is None:
+        return None
+    if hasattr(valore, 'strftime'):
+        return valore.strftime('%d/%m/%Y')
+    if isinstance(valore, float):
+        # i file dei clienti usano la virgola decimale
+        return str(valore).replace('.', ',')
+    return valore
+
+
+def crea_workbook(profilo, n_righe, seed=7, nome_foglio='Giacenze'):
+    """Ritorna un Workbook openpyxl con `n_righe` articoli per il profilo dato."""
+    rnd = random.Random(seed)
+    header_row = profilo.get('header_row', 0)
+    colonne = list(profilo.get('column_map', {}).items())
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = nome_foglio
+    if header_row:
+        ws.append(['CAMAR SRL - ELENCO GIACENZE'])
+        for _ in range(header_row - 1):
+            ws.append([])
+    ws.append([excel_col for excel_col, _ in colonne])
+    for riga in genera_articoli(n_righe, seed=seed):
+        ws.append([_valore_cella(riga, db_col, rnd) for _, db_col in colonne])
+    return wb
+
+
+def crea_file_excel(profilo, n_righe, seed=7):
+    """Come `crea_workbook` ma ritorna un BytesIO pronto per l'upload."""
+    output = io.BytesIO()
+    crea_workbook(profilo, n_righe, seed=seed).save(output)
+    output.seek(0)
+    return output
+
+
+def crea_file_excel_multifoglio(profilo, n_righe, n_fogli, seed=7):
+    """Un workbook con `n_fogli` fogli ('Commessa 1', ...) di `n_righe` articoli ciascuno."""
+    wb = crea_workbook(profilo, n_righe, seed=seed, nome_foglio='Commessa 1')
+    for i in range(2, n_fogli + 1):
+        foglio = crea_workbook(profilo, n_righe, seed=seed + i).active
+        ws = wb.create_sheet(f'Commessa {i}')
+        for riga in foglio.iter_rows(values_only=True):
+            ws.append(riga)
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return output
+
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Esecuzione degli scenari di benchmark tramite il test client di Flask.
+
+Per ogni scenario misura il tempo (mediana/min/max su più ripetizioni) e il
+picco di memoria Python (tracemalloc, in un passaggio separato per non
+falsare i tempi). I risultati sono scritti in JSON.
+
+    python -m bench.run --righe 100000
+    python -m bench.run --tutti-i-profili   # anche un import per ogni profilo Excel
+    python -m bench.run --confronta vecchio.json nuovo.json
+"""
+import argparse
+import functools
+import io
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime
+from pathlib import Path
+
+from bench.dati import popola_database
+from bench.fixture_excel import carica_profili, crea_file_excel, crea_file_excel_multifoglio
+
+RADICE = Path(__file__).resolve().parent.parent
+CARTELLA_RISULTATI = Path(__file__).resolve().parent / 'risultati'
+PROFILO_IMPORT = 'Giacenze Fincantieri'
+FOGLI_IMPORT = 4
+
+
+# --- PREPARAZIONE AMBIENTE ---
+def prepara_ambiente(cartella_dati, righe, seed):
+    """
+    Importa l'app puntando RENDER_DISK_PATH alla cartella di benchmark e la
+    popola se il database non contiene già il numero di righe richiesto.
+    """
+    cartella_dati = Path(cartella_dati)
+    (cartella_dati / 'config').mkdir(parents=True, exist_ok=True)
+    with open(cartella_dati / 'config' / 'mappe_excel.json', 'w', encoding='utf-8') as f:
+        json.dump(carica_profili(), f, ensure_ascii=False, indent=4)
+
+    os.environ['RENDER_DISK_PATH'] = str(cartella_dati)
+    # i dati generati devono restare nella tabella attiva tra un'esecuzione e l'altra
+    os.environ.setdefault('ARCHIVIO_AUTOMATICO', '0')
+    sys.path.insert(0, str(RADICE))
+    import app as gestionale
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # initialize_app copia il DB a ogni avvio: nella cartella di benchmark non serve
+    shutil.rmtree(gestionale.BACKUP_FOLDER, ignore_errors=True)
+    os.makedirs(gestionale.BACKUP_FOLDER, exist_ok=True)
+
+    with gestionale.app.app_context():
+        esistenti = gestionale.Articolo.query.count()
+        if esistenti != righe:
+            if esistenti:
+                gestionale.Allegato.query.delete()
+                gestionale.Articolo.query.delete()
+                gestionale.db.session.commit()
+            t0 = time.perf_counter()
+            n_art, n_all = popola_database(
+                gestionale.db, gestionale.Articolo, gestionale.Allegato, righe, seed=seed
+            )
+            print(f"Generati {n_art} articoli e {n_all} allegati in {time.perf_counter() - t0:.1f}s")
+    return gestionale
+
+
+def client_autenticato(gestionale, utente='ADMIN'):
+    client = gestionale.app.test_client()
+    with client.session_transaction() as s:
+        s['user'] = utente
+        s['role'] = 'admin' if utente in gestionale.ADMIN_USERS else 'client'
+    return client
+
+
+# --- SCENARI ---
+class Scenario:
+    """Una richiesta da misurare, con eventuale ripristino dei dati dopo ogni esecuzione."""
+
+    def __init__(self, nome, esegui, utente='ADMIN', prepara=None, ripristina=None, atteso=(200,)):
+        self.nome = nome
+        self.esegui = esegui
+        self.utente = utente
+        self.prepara = prepara
+        self.ripristina = ripristina
+        self.atteso = atteso
+
+
+def _nome_scenario_profilo(nome_profilo):
+    return 'import_' + re.sub(r'[^0-9a-z]+', '_', nome_profilo.lower()).strip('_')
+
+
+def costruisci_scenari(gestionale, righe_import, tutti_i_profili=False):
+    Articolo = gestionale.Articolo
+    with gestionale.app.app_context():
+        ids_buono = [r[0] for r in gestionale.db.session.query(Articolo.id)
+                     .filter(Articolo.cliente == 'FINCANTIERI').order_by(Articolo.id).limit(50)]
+    ids_buono = ','.join(str(i) for i in ids_buono)
+    oggi = date.today()
+    mese_prec = f"{oggi.year if oggi.month > 1 else oggi.year - 1}-{(oggi.month - 2) % 12 + 1:02d}"
+    profili = carica_profili()
+    profilo = profili[PROFILO_IMPORT]
+    stato_import = {}
+
+    def prepara_import(nome_profilo=PROFILO_IMPORT):
+        with gestionale.app.app_context():
+            stato_import['max_id'] = gestionale.db.session.query(gestionale.db.func.max(Articolo.id)).scalar() or 0
+        stato_import['contenuto'] = crea_file_excel(profili[nome_profilo], righe_import).getvalue()
+
+    def esegui_import(c, nome_profilo=PROFILO_IMPORT):
+        data = {'profile': nome_profilo, 'file': (io.BytesIO(stato_import['contenuto']), 'bench.xlsx')}
+        r = c.post('/import', data=data, content_type='multipart/form-data', follow_redirects=True)
+        inseriti = re.search(rb'(\d+) articoli aggiunti', r.data)
+        if r.status_code != 200 or b'table-danger' in r.data or not inseriti or inseriti.group(1) == b'0':
+            raise RuntimeError(f'Import fallito ({nome_profilo}).')
+        return r
+
+    def prepara_import_multi():
+        prepara_import()
+        stato_import['contenuto'] = crea_file_excel_multifoglio(profilo, righe_import, FOGLI_IMPORT).getvalue()
+
+    def esegui_import_multi(c):
+        # passo 1: upload e scelta fogli; passo 2: tutti i fogli con lo stesso profilo
+        data = {'profile': PROFILO_IMPORT, 'scegli_fogli': '1',
+                'file': (io.BytesIO(stato_import['contenuto']), 'bench_multi.xlsx')}
+        r = c.post('/import', data=data, content_type='multipart/form-data')
+        token = re.search(rb'name="token" value="([0-9a-f]+)"', r.data).group(1).decode()
+        scelte = [f'0:Commessa {i}' for i in range(1, FOGLI_IMPORT + 1)]
+        form = {'token': token, 'foglio': scelte} | {f'profilo_{s}': PROFILO_IMPORT for s in scelte}
+        r = c.post('/import/fogli', data=form, follow_redirects=True)
+        if r.status_code != 200 or b'table-danger' in r.data:
+            raise RuntimeError('Import multi-foglio fallito.')
+        return r
+
+    def ripristina_import():
+        with gestionale.app.app_context():
+            Articolo.query.filter(Articolo.id > stato_import['max_id']).delete(synchronize_session=False)
+            gestionale.db.session.commit()
+
+    arrivi = [{'cliente': 'FINCANTIERI', 'codice_articolo': f'SCAN{i:04d}', 'n_colli': '1',
+               'lunghezza': '1,20', 'larghezza': '0,80', 'altezza': '1', 'posizione': 'A-01-01',
+               'data_ingresso': oggi.isoformat()} for i in range(500)]
+
+    def esegui_api_batch(c):
+        r = c.post('/api/articoli/batch', json=arrivi)
+        if r.status_code != 201:
+            raise RuntimeError(f"API batch fallita: {r.get_data(as_text=True)[:200]}")
+        return r
+
+    etichetta = {
+        'cliente': 'FINCANTIERI', 'fornitore': 'WARTSILA', 'ordine': 'OA12345', 'commessa': '6123',
+        'n_arrivo': '45/25', 'n_colli': '3',
+    }
+
+    # con --tutti-i-profili: un import per ogni profilo di mappe_excel.json (header_row e colonne diverse)
+    scenari_profili = [
+        Scenario(_nome_scenario_profilo(nome), functools.partial(esegui_import, nome_profilo=nome),
+                 prepara=functools.partial(prepara_import, nome), ripristina=ripristina_import)
+        for nome in profili if nome != PROFILO_IMPORT
+    ] if tutti_i_profili else []
+
+    def anteprima_buono(c):
+        return c.post(f'/buono/preview?ids={ids_buono}', data={
+            'buono_n': 'BENCH', 'cliente': 'FINCANTIERI', 'commessa': '6123', 'protocollo': 'P1'})
+
+    def anteprima_etichetta(c):
+        return c.post('/etichetta/preview', data=etichetta)
+
+    return [
+        Scenario('giacenze_admin', lambda c: c.get('/giacenze')),
+        Scenario('giacenze_cliente', lambda c: c.get('/giacenze'), utente='FINCANTIERI'),
+        Scenario('giacenze_filtro', lambda c: c.get('/giacenze', query_string={
+            'cliente': 'DE WAVE', 'data_ingresso_da': f"{oggi.year - 1}-01-01"})),
+        Scenario('export', lambda c: c.get('/export')),
+        Scenario('export_filtro', lambda c: c.get('/export', query_string={'cliente': 'SCORZA'})),
+        Scenario('export_tutti', lambda c: c.post('/export/cliente', data={'tutti': '1'})),
+        Scenario('export_parquet', lambda c: c.get('/export/analisi', query_string={'formato': 'parquet'})),
+        Scenario('import', esegui_import, prepara=prepara_import, ripristina=ripristina_import),
+        Scenario('import_multi', esegui_import_multi, prepara=prepara_import_multi, ripristina=ripristina_import),
+        Scenario('api_batch', esegui_api_batch, prepara=prepara_import, ripristina=ripristina_import, atteso=(201,)),
+        Scenario('report', lambda c: c.post('/report', data={'cliente': 'FINCANTIERI', 'mese_anno': mese_prec})),
+        # anteprime: la cache viene svuotata dopo ogni esecuzione per misurare il rendering;
+        # le varianti *_cache misurano invece la risposta dalla cache
+        Scenario('buono_preview', anteprima_buono, ripristina=gestionale.CACHE_ANTEPRIME.svuota),
+        Scenario('etichetta_preview', anteprima_etichetta, ripristina=gestionale.CACHE_ANTEPRIME.svuota),
+        Scenario('buono_preview_cache', anteprima_buono),
+        Scenario('etichetta_preview_cache', anteprima_etichetta),
+        Scenario('posizioni', lambda c: c.get('/posizioni')),
+        Scenario('posizioni_libere', lambda c: c.get('/api/posizioni/libere', query_string={'m2': '5'})),
+    ] + scenari_profili
+
+
+def misura(gestionale, scenario, ripetizioni):
+    """Esegue lo scenario: un riscaldamento, `ripetizioni` misure di tempo e una di memoria."""
+    client = client_autenticato(gestionale, scenario.utente)
+    if scenario.prepara:
+        scenario.prepara()
+
+    def una_esecuzione():
+        risposta = scenario.esegui(client)
+        if risposta.status_code not in scenario.atteso:
+            raise RuntimeError(f"{scenario.nome}: status {risposta.status_code}")
+        n_byte = len(risposta.get_data())
+        # come il server WSGI: la chiusura rilascia lo slot del controllo di ammissione
+        risposta.close()
+        if scenario.ripristina:
+            scenario.ripristina()
+        return n_byte
+
+    n_byte = una_esecuzione()
+    tempi = []
+    for _ in range(ripetizioni):
+        t0 = time.perf_counter()
+        risposta = scenario.esegui(client)
+        risposta.get_data()
+        tempi.append(time.perf_counter() - t0)
+        risposta.close()
+        if scenario.ripristina:
+            scenario.ripristina()
+
+    tracemalloc.start()
+    una_esecuzione()
+    _, picco = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'ripetizioni': ripetizioni,
+        'mediana_s': round(statistics.median(tempi), 4),
+        'min_s': round(min(tempi), 4),
+        'max_s': round(max(tempi), 4),
+        'media_s': round(statistics.fmean(tempi), 4),
+        'picco_memoria_mb': round(picco / 1024 / 1024, 2),
+        'byte_risposta': n_byte,
+    }
+
+
+# --- RISULTATI ---
+def metadati(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=RADICE,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'piattaforma': platform.platform(),
+        'righe': args.righe,
+        'seed': args.seed,
+        'righe_import': args.righe_import,
+    }
+
+
+def confronta(file_a, file_b):
+    with open(file_a, 'r', encoding='utf-8') as f:
+        a = json.load(f)
+    with open(file_b, 'r', encoding='utf-8') as f:
+        b = json.load(f)
+    print(f"{'scenario':<20} {'prima (s)':>10} {'dopo (s)':>10} {'delta':>8} {'mem prima':>10} {'mem dopo':>10}")
+    for nome, rb in b['risultati'].items():
+        ra = a['risultati'].get(nome)
+        if not ra or 'errore' in ra or 'errore' in rb:
+            continue
+        delta = (rb['mediana_s'] - ra['mediana_s']) / ra['mediana_s'] * 100 if ra['mediana_s'] else 0
+        print(f"{nome:<20} {ra['mediana_s']:>10.4f} {rb['mediana_s']:>10.4f} {delta:>+7.1f}% "
+              f"{ra['picco_memoria_mb']:>10.2f} {rb['picco_memoria_mb']:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark delle rotte principali del gestionale.')
+    parser.add_argument('--righe', type=int, default=10000, help='Numero di articoli (es. 10000, 100000, 1000000)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--ripetizioni', type=int, default=5)
+    parser.add_argument('--righe-import', type=int, default=1000, help='Righe del file Excel importato')
+    parser.add_argument('--scenari', default='', help='Elenco separato da virgole (default: tutti)')
+    parser.add_argument('--tutti-i-profili', action='store_true',
+                        help="Aggiunge uno scenario di import per ogni profilo di mappe_excel.json")
+    parser.add_argument('--cartella-dati', default=None,
+                        help='Cartella del DB di benchmark; riusarla evita di rigenerare i dati')
+    parser.add_argument('--output', default=None, help='File JSON dei risultati')
+    parser.add_argument('--confronta', nargs=2, metavar=('PRIMA', 'DOPO'), help='Confronta due file di risultati')
+    args = parser.parse_args(argv)
+
+    if args.confronta:
+        confronta(*args.confronta)
+        return
+
+    cartella_dati = args.cartella_dati or Path(tempfile.gettempdir()) / f"gestionale_bench_{args.righe}_{args.seed}"
+    gestionale = prepara_ambiente(cartella_dati, args.righe, args.seed)
+
+    scenari = costruisci_scenari(gestionale, args.righe_import, args.tutti_i_profili)
+    selezionati = {s.strip() for s in args.scenari.split(',') if s.strip()}
+    if selezionati:
+        scenari = [s for s in scenari if s.nome in selezionati]
+
+    risultati = {}
+    for scenario in scenari:
+        try:
+            risultati[scenario.nome] = misura(gestionale, scenario, args.ripetizioni)
+            r = risultati[scenario.nome]
+            print(f"{scenario.nome:<20} mediana {r['mediana_s']:.4f}s  picco {r['picco_memoria_mb']:.1f} MB")
+        except Exception as e:
+            logging.error(f"Scenario {scenario.nome} fallito: {e}", exc_info=True)
+            risultati[scenario.nome] = {'errore': str(e)}
+
+    output = Path(args.output) if args.output else (
+        CARTELLA_RISULTATI / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{args.righe}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'meta': metadati(args), 'risultati': risultati}, f, indent=2, ensure_ascii=False)
+    print(f"Risultati salvati in {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Verifica di equivalenza tra valori_articoli_batch (API batch, vettoriale) e
+valori_articolo (form/import, riga per riga) su record casuali.
+
+I record mescolano chiavi presenti e assenti, codici inviati come numeri JSON
+(anche barcode a 19 cifre), decimali con la virgola, date nei due formati e
+valori vuoti: sono i casi in cui l'inferenza dei tipi di pandas può divergere.
+
+    python -m bench.verifica_batch --record 3000
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+from datetime import date, timedelta
+from pathlib import Path
+
+RADICE = Path(__file__).resolve().parent.parent
+
+CAMPI_TESTO = ['codice_articolo', 'descrizione', 'cliente', 'fornitore', 'n_ddt_ingresso',
+               'commessa', 'ordine', 'posizione', 'protocollo', 'n_arrivo', 'buono_n']
+CAMPI_NUMERO = ['peso', 'larghezza', 'lunghezza', 'altezza']
+CAMPI_DATA = ['data_ingresso', 'data_uscita']
+
+
+def _valore_testo(rnd):
+    return rnd.choice([
+        rnd.randint(1, 999999),                                    # codice come numero JSON
+        rnd.randint(10 ** 18, 9 * 10 ** 18),                       # barcode a 19 cifre
+        f"{rnd.randint(100000, 999999)}-{rnd.randint(1, 99):02d}",
+        rnd.choice(['CASSA', 'PALLET', 'FINCANTIERI', 'A-01-01']),
+        round(rnd.uniform(0, 100), 2), '', None, 'None', 0,
+    ])
+
+
+def _valore_numero(rnd):
+    return rnd.choice([
+        rnd.randint(0, 20), round(rnd.uniform(0.1, 6), 2),
+        f"{rnd.uniform(0.1, 6):.2f}".replace('.', ','), f"{rnd.uniform(0.1, 6):.2f}",
+        '', None, 'n.d.', rnd.randint(10 ** 18, 9 * 10 ** 18),
+    ])
+
+
+def _valore_data(rnd):
+    giorno = date(2020, 1, 1) + timedelta(days=rnd.randint(0, 2000))
+    return rnd.choice([giorno.isoformat(), giorno.strftime('%d/%m/%Y'), '', None, '31/02/2024', 20240101])
+
+
+def genera_record(rnd):
+    """Un record API con un sottoinsieme casuale delle chiavi."""
+    record = {}
+    for nome in CAMPI_TESTO:
+        if rnd.random() < 0.5:
+            record[nome] = _valore_testo(rnd)
+    for nome in CAMPI_NUMERO:
+        if rnd.random() < 0.5:
+            record[nome] = _valore_numero(rnd)
+    for nome in CAMPI_DATA:
+        if rnd.random() < 0.5:
+            record[nome] = _valore_data(rnd)
+    if rnd.random() < 0.5:
+        record['n_colli'] = rnd.choice([1, 3, '2', '2,5', 4.0, '', None, 'x'])
+    if rnd.random() < 0.3:
+        record['stato'] = rnd.choice(['NAZIONALE', 'DOGANALE', '', None])
+    return record
+
+
+def _uguali(nome, atteso, ottenuto, gestionale):
+    """Confronto come lo vedrebbe il DB (SQLite converte i numeri nelle colonne di testo)."""
+    if atteso is None or ottenuto is None:
+        return atteso is None and ottenuto is None
+    tipo = gestionale.Articolo.__table__.c[nome].type.python_type
+    if tipo is str:
+        return str(atteso) == str(ottenuto)
+    if tipo is float:
+        return math.isclose(float(atteso), float(ottenuto), rel_tol=1e-12)
+    return atteso == ottenuto
+
+
+def verifica(gestionale, lotti):
+    """
+    Lista di (indice, colonna, atteso, ottenuto) per i valori che differiscono.
+    I record sono convertiti per lotti: i tipi dedotti da pandas dipendono da
+    quali valori finiscono nello stesso lotto.
+    """
+    tabella = gestionale.Articolo.__table__
+    records = [r for lotto in lotti for r in lotto]
+    batch = [v for lotto in lotti for v in gestionale.valori_articoli_batch([dict(r) for r in lotto])]
+    differenze = []
+    for i, (record, ottenuti) in enumerate(zip(records, batch)):
+        attesi = gestionale.valori_articolo(record)
+        for nome, ottenuto in ottenuti.items():
+            if nome in attesi:
+                atteso = attesi[nome]
+            else:
+                # colonna non impostata: al momento dell'insert vale il default della colonna
+                default = tabella.c[nome].default
+                atteso = default.arg if default is not None else None
+            if not _uguali(nome, atteso, ottenuto, gestionale):
+                differenze.append((i, nome, atteso, ottenuto))
+    return differenze
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Equivalenza tra API batch e import riga per riga.')
+    parser.add_argument('--record', type=int, default=3000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('RENDER_DISK_PATH', tempfile.mkdtemp(prefix='gestionale_verifica_'))
+    os.environ.setdefault('ARCHIVIO_AUTOMATICO', '0')
+    sys.path.insert(0, str(RADICE))
+    import app as gestionale
+
+    rnd = random.Random(args.seed)
+    records = [genera_record(rnd) for _ in range(args.record)]
+    lotti = []
+    while records:
+        n = rnd.choice([1, 2, 5, 20, 200])
+        lotti.append(records[:n])
+        records = records[n:]
+    # casi fissi: chiave numerica presente in un record e assente nell'altro
+    lotti.append([{'codice_articolo': 123456}, {'cliente': 'X'}])
+    lotti.append([{'codice_articolo': 8012345678901234567, 'n_colli': 2}, {'peso': '1,5'}])
+
+    with gestionale.app.app_context():
+        differenze = verifica(gestionale, lotti)
+    for i, nome, atteso, ottenuto in differenze[:20]:
+        print(f"record {i} {nome}: atteso {atteso!r}, ottenuto {ottenuto!r}")
+    print(f"{sum(len(l) for l in lotti)} record in {len(lotti)} lotti, {len(differenze)} differenze")
+    sys.exit(1 if differenze else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Funzioni eseguite nei process pool del gestionale (export per cliente, lettura
+dei fogli di import) e conversioni dei valori articolo che usano.
+
+Il modulo non importa app: i processi figli partono dal forkserver (o con
+spawn) e caricano solo questo file, senza rieseguire initialize_app e senza
+ereditare thread, lock su file e connessioni SQLite del worker gunicorn.
+"""
+import io
+import multiprocessing
+import re
+import time
+from datetime import datetime
+
+import pandas as pd
+
+
+def contesto_processi():
+    """Contesto per i ProcessPoolExecutor: forkserver dove disponibile, altrimenti spawn."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        contesto = multiprocessing.get_context('forkserver')
+        # il forkserver carica pandas una volta sola, i figli nascono già pronti
+        contesto.set_forkserver_preload([__name__])
+        return contesto
+    return multiprocessing.get_context('spawn')
+
+
+def nome_sicuro(nome, max_len=31):
+    """Nome valido per fogli Excel e file nello ZIP."""
+    return re.sub(r'[\\/*?:\[\]]', '_', nome).strip()[:max_len] or 'export'
+
+
+def workbook_cliente(cliente, colonne, righe):
+    """Ritorna (cliente, byte dell'xlsx, numero righe)."""
+    df = pd.DataFrame(righe, columns=colonne)
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name=nome_sicuro(cliente))
+    return cliente, output.getvalue(), len(righe)
+
+
+def to_float_safe(val):
+    if val is None: return None
+    try: return float(str(val).replace(',', '.'))
+    except (ValueError, TypeError): return None
+
+
+def to_int_safe(val):
+    f_val = to_float_safe(val)
+    return int(f_val) if f_val is not None else None
+
+
+def parse_date_safe(date_string):
+    if not date_string: return None
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y'):
+        try: return datetime.strptime(str(date_string), fmt).date()
+        except (ValueError, TypeError): continue
+    return None
+
+
+def calculate_m2_m3(form_data):
+    l = to_float_safe(form_data.get('lunghezza', 0)) or 0
+    w = to_float_safe(form_data.get('larghezza', 0)) or 0
+    h = to_float_safe(form_data.get('altezza', 0)) or 0
+    c = to_int_safe(form_data.get('n_colli', 1)) or 1
+    m2 = round(l * w * c, 3)
+    m3 = round(l * w * h * c, 3)
+    return m2, m3
+
+
+def valori_colonne(form, colonne):
+    """
+    Valori delle `colonne` di Articolo dai dati form/import, senza toccare il DB.
+    - Non manipola 'stato' (viene rispettato ciò che arriva dal form/import).
+    - Calcola m2/m3 quando sono presenti dati dimensione/colli.
+    """
+    valori = {}
+    for nome in colonne:
+        if nome in form:
+            value = form.get(nome)
+            if nome == 'stato':
+                # NON manipolare automaticamente; copia solo ciò che arriva.
+                valori[nome] = value if value else None
+            elif 'data' in nome:
+                valori[nome] = parse_date_safe(value)
+            elif nome in ['peso', 'larghezza', 'lunghezza', 'altezza']:
+                valori[nome] = to_float_safe(value)
+            elif nome in ['n_colli']:
+                valori[nome] = to_int_safe(value)
+            else:
+                valori[nome] = value if (value not in [None, '', 'None']) else None
+
+    if any(k in form for k in ['lunghezza', 'larghezza', 'altezza', 'n_colli']):
+        calc_data = {
+            'lunghezza': form.get('lunghezza'),
+            'larghezza': form.get('larghezza'),
+            'altezza': form.get('altezza'),
+            'n_colli': form.get('n_colli')
+        }
+        valori['m2'], valori['m3'] = calculate_m2_m3(calc_data)
+    return valori
+
+
+def leggi_foglio(percorso, nome_file, foglio, nome_profilo, profilo, colonne):
+    """
+    Legge un foglio (None = il primo) e ritorna le righe già convertite con
+    valori_colonne, più l'eventuale errore. `colonne`: colonne di Articolo.
+    """
+    inizio = time.perf_counter()
+    esito = {'file': nome_file, 'foglio': foglio, 'profilo': nome_profilo, 'righe': [], 'errore': None}
+    try:
+        df = pd.read_excel(
+            percorso,
+            sheet_name=foglio if foglio is not None else 0,
+            header=profilo.get('header_row', 0),
+            dtype=str,
+            engine='openpyxl'
+        ).fillna('')
+
+        col_map = profilo.get('column_map', {})
+        # campi validi esistenti nel modello
+        mappa = [(excel_col, db_col) for excel_col, db_col in col_map.items() if db_col in colonne]
+
+        for row in df.itertuples(index=False):
+            riga = dict(zip(df.columns, row))
+            # se nessuna colonna mappata ha dati, salta
+            if not any(riga.get(excel_col, '') for excel_col in col_map.keys()):
+                continue
+            form_data = {}
+            for excel_col, db_col in mappa:
+                value = str(riga.get(excel_col, '')).strip()
+                # evita 'nan'/'None' come stringhe
+                form_data[db_col] = None if value.lower() in ['nan', 'none', ''] else value
+            esito['righe'].append(valori_colonne(form_data, colonne))
+    except Exception as e:
+        esito['errore'] = str(e)
+    esito['durata_s'] = round(time.perf_counter() - inizio, 2)
+    return esito